@@ -1,7 +1,31 @@
+import io
 import os
 import re
-from datetime import datetime
+import json
+import base64
+import shutil
+import tarfile
+import tempfile
+import urllib.request
+import time
+import random
+import logging
+import hashlib
+import hmac
+import textwrap
+import uuid
+import zlib
+import atexit
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from functools import lru_cache
+from types import SimpleNamespace
 
+import click
 import openai
 from flask import (
     Flask,
@@ -9,11 +33,22 @@ from flask import (
     request,
     jsonify,
     make_response,
+    Response,
+    stream_with_context,
+    g,
+    has_app_context,
+    has_request_context,
     redirect,
+    session,
     url_for,
     flash
 )
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import DDL, Select, event, insert, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
 from flask_migrate import Migrate
 from flask_login import (
     LoginManager,
@@ -25,29 +60,276 @@ from flask_login import (
 )
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename  # Para manejo seguro de nombres de archivo
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 import PyPDF2  # Para extraer texto de PDFs
 from docx import Document  # Para extraer texto de archivos DOCX
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess
+)
+
+try:
+    import tiktoken  # Conteo exacto de tokens (opcional)
+except ImportError:
+    tiktoken = None
 
-# Configuración de la clave API de OpenAI
-openai.api_key = os.environ.get("OPENAI_API_KEY")
+try:
+    import zstandard  # Compresión del archivo de mensajes (opcional; sin él se usa zlib)
+except ImportError:
+    zstandard = None
+
+# Configuración del cliente de OpenAI (la clave y OPENAI_BASE_URL se leen del entorno).
+# Un único cliente por proceso comparte su pool de conexiones HTTP; con workers gevent
+# cada petición en vuelo cuesta un socket, no un worker.
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", 300))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 2))
 
 # Inicialización de Flask y configuración
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY", "este-es-un-secreto")
+# Render antepone un proxy: la IP real del alumno llega en X-Forwarded-For
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.environ.get("PROXY_SALTOS", 1)))
 
 # Configuración de la base de datos
 database_url = os.environ.get("DATABASE_URL", "sqlite:///conversations.db").replace("postgres://", "postgresql://", 1)
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+
+# Pool de conexiones por proceso, según el modelo de workers de gunicorn: un worker
+# gevent atiende cientos de peticiones a la vez y necesita más conexiones que uno
+# sync, que solo usa la petición en curso y las tareas en segundo plano. En total se
+# abren hasta WEB_CONCURRENCY × (DB_POOL_SIZE + DB_MAX_OVERFLOW) por base de datos.
+workers_gevent = os.environ.get("GUNICORN_WORKER_CLASS", "gevent") == "gevent"
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    "pool_size": int(os.environ.get("DB_POOL_SIZE", 10 if workers_gevent else 2)),
+    "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 20 if workers_gevent else 3)),
+    "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", 30)),
+    # Conexiones cortadas por el proveedor (Render cierra las inactivas) se detectan
+    # antes de usarlas y se renuevan periódicamente
+    "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING", "1") == "1",
+    "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800))
+}
+
+# Réplica de solo lectura opcional para /export, /resumen, el historial del chat y
+# load_user. Para probar en local basta con copiar el archivo SQLite de la primaria:
+#   DATABASE_URL=sqlite:///primaria.db DATABASE_REPLICA_URL=sqlite:///replica.db
+replica_url = os.environ.get("DATABASE_REPLICA_URL")
+if replica_url:
+    app.config['SQLALCHEMY_BINDS'] = {'replica': replica_url.replace("postgres://", "postgresql://", 1)}
+
+# Presupuesto de contexto para el modo memoria
+app.config['MEMORIA_TOKENS_MAX'] = int(os.environ.get("MEMORIA_TOKENS_MAX", 16000))
+app.config['MEMORIA_FILAS_MAX'] = int(os.environ.get("MEMORIA_FILAS_MAX", 200))
+# Resumen continuo: mensajes recientes que se envían sin resumir y tamaño de cada pliegue
+app.config['RESUMEN_TURNOS_RECIENTES'] = int(os.environ.get("RESUMEN_TURNOS_RECIENTES", 12))
+app.config['RESUMEN_LOTE'] = int(os.environ.get("RESUMEN_LOTE", 20))
+# Pliegues (llamadas al modelo) como máximo por actualización en segundo plano; el
+# primer resumen de un usuario también parte de ese tramo y no de todo su historial
+app.config['RESUMEN_PLIEGUES_MAX'] = int(os.environ.get("RESUMEN_PLIEGUES_MAX", 3))
+# Retención: días que un mensaje queda en la tabla `message` antes de archivarse, y
+# filas por lote al archivar o al borrar con /clear (transacciones y bloqueos cortos)
+app.config['RETENCION_DIAS'] = int(os.environ.get("RETENCION_DIAS", 180))
+app.config['BORRADO_LOTE'] = int(os.environ.get("BORRADO_LOTE", 1000))
+# Mensajes por página de /history (el cliente puede pedir hasta HISTORIAL_PAGINA_MAX)
+app.config['HISTORIAL_PAGINA'] = int(os.environ.get("HISTORIAL_PAGINA", 50))
+app.config['HISTORIAL_PAGINA_MAX'] = int(os.environ.get("HISTORIAL_PAGINA_MAX", 200))
+# Puntos clave por página de /resumen, con el mismo esquema
+app.config['PUNTOS_CLAVE_PAGINA'] = int(os.environ.get("PUNTOS_CLAVE_PAGINA", 50))
+app.config['PUNTOS_CLAVE_PAGINA_MAX'] = int(os.environ.get("PUNTOS_CLAVE_PAGINA_MAX", 200))
+# Segundos que cada proceso reutiliza un prompt de sistema antes de releerlo
+app.config['PROMPT_CACHE_TTL'] = int(os.environ.get("PROMPT_CACHE_TTL", 60))
+
+# Ingesta de archivos en segundo plano
+app.config['UPLOAD_SPOOL_DIR'] = os.environ.get("UPLOAD_SPOOL_DIR", os.path.join(app.instance_path, 'subidas'))
+app.config['UPLOAD_PROCESOS'] = int(os.environ.get("UPLOAD_PROCESOS", 2))
+app.config['UPLOAD_PAGINAS_POR_TAREA'] = int(os.environ.get("UPLOAD_PAGINAS_POR_TAREA", 25))
+# Minutos sin progreso tras los que un trabajo pendiente se da por perdido (p. ej. un
+# redeploy mató al worker que lo tenía en su cola en memoria)
+app.config['UPLOAD_TRABAJO_MAX_MIN'] = int(os.environ.get("UPLOAD_TRABAJO_MAX_MIN", 30))
+
+# Fragmentos de documentos: tamaño al indexar y cuántos se recuperan por turno
+app.config['FRAGMENTO_CARACTERES'] = int(os.environ.get("FRAGMENTO_CARACTERES", 2000))
+app.config['FRAGMENTOS_POR_TURNO'] = int(os.environ.get("FRAGMENTOS_POR_TURNO", 5))
+
+# Caché de respuestas del modelo para comandos deterministas (desactivada por defecto)
+app.config['LLM_CACHE'] = os.environ.get("LLM_CACHE", "0") == "1"
+app.config['LLM_CACHE_TTL'] = int(os.environ.get("LLM_CACHE_TTL", 24 * 3600))
+app.config['LLM_CACHE_MAX_MEMORIA'] = int(os.environ.get("LLM_CACHE_MAX_MEMORIA", 512))
+app.config['LLM_CACHE_MAX_FILAS'] = int(os.environ.get("LLM_CACHE_MAX_FILAS", 10000))
+# La tabla se poda cada tantas inserciones por proceso, no en cada fallo de caché
+app.config['LLM_CACHE_PODA_CADA'] = int(os.environ.get("LLM_CACHE_PODA_CADA", 200))
+
+# Caché de usuarios para load_user: por proceso (TTL/LRU) y, opcionalmente, en la cookie
+# de sesión firmada, que es la misma para todos los workers
+app.config['USUARIOS_CACHE_TTL'] = int(os.environ.get("USUARIOS_CACHE_TTL", 30))
+app.config['USUARIOS_CACHE_MAX'] = int(os.environ.get("USUARIOS_CACHE_MAX", 4096))
+app.config['USUARIO_EN_SESION'] = os.environ.get("USUARIO_EN_SESION", "0") == "1"
+app.config['USUARIO_EN_SESION_TTL'] = int(os.environ.get("USUARIO_EN_SESION_TTL", 300))
+
+# Planificador de llamadas a OpenAI. OPENAI_TPM es el presupuesto de la cuenta; cada
+# worker administra su parte (OPENAI_TPM / WEB_CONCURRENCY). 0 = sin presupuesto.
+# Con gunicorn, gunicorn.conf.py fija WEB_CONCURRENCY al número real de workers antes
+# de cargar la app; el 1 por defecto es para `flask run` (un solo proceso).
+app.config['OPENAI_CONCURRENCIA_USUARIO'] = int(os.environ.get("OPENAI_CONCURRENCIA_USUARIO", 2))
+app.config['OPENAI_CONCURRENCIA_GLOBAL'] = int(os.environ.get("OPENAI_CONCURRENCIA_GLOBAL", 64))
+app.config['OPENAI_TPM'] = int(os.environ.get("OPENAI_TPM", 0)) // int(os.environ.get("WEB_CONCURRENCY", 1))
+app.config['OPENAI_SALIDA_ESTIMADA'] = int(os.environ.get("OPENAI_SALIDA_ESTIMADA", 1000))
+app.config['OPENAI_REINTENTOS_429'] = int(os.environ.get("OPENAI_REINTENTOS_429", 4))
+app.config['OPENAI_ESPERA_MAX'] = float(os.environ.get("OPENAI_ESPERA_MAX", 60))
+
+# Hash de contraseñas en procesos aparte, con un tope de hashes en espera por worker.
+# Al cambiar HASH_METODO, las contraseñas se rehashean solas en el siguiente login.
+app.config['HASH_METODO'] = os.environ.get("HASH_METODO", "scrypt:32768:8:1")
+app.config['HASH_PROCESOS'] = int(os.environ.get("HASH_PROCESOS", 2))
+app.config['HASH_COLA_MAX'] = int(os.environ.get("HASH_COLA_MAX", 16))
+# Límite de intentos de login/registro (cubeta de tokens: ráfaga y recarga por minuto),
+# guardado en un SQLite local que comparten todos los workers del servidor. En el login
+# solo cuentan los intentos fallidos: un curso entero entra detrás de la misma IP (NAT)
+app.config['LIMITES_DB'] = os.environ.get("LIMITES_DB", os.path.join(app.instance_path, "limites.db"))
+app.config['LOGIN_RAFAGA_IP'] = int(os.environ.get("LOGIN_RAFAGA_IP", 30))
+app.config['LOGIN_POR_MINUTO_IP'] = float(os.environ.get("LOGIN_POR_MINUTO_IP", 30))
+app.config['LOGIN_RAFAGA_USUARIO'] = int(os.environ.get("LOGIN_RAFAGA_USUARIO", 5))
+app.config['LOGIN_POR_MINUTO_USUARIO'] = float(os.environ.get("LOGIN_POR_MINUTO_USUARIO", 5))
+
+# Escritura diferida de mensajes: '' (desactivada), 'grupo' (la petición espera el commit
+# de su lote) o 'async' (responde sin esperar; un fallo del proceso puede perder el último lote)
+app.config['ESCRITURA_DIFERIDA'] = os.environ.get("ESCRITURA_DIFERIDA", "")
+app.config['ESCRITURA_LOTE_MAX'] = int(os.environ.get("ESCRITURA_LOTE_MAX", 500))
+app.config['ESCRITURA_INTERVALO_MS'] = int(os.environ.get("ESCRITURA_INTERVALO_MS", 50))
+
+# Métricas: token que exige /metrics (sin él, el endpoint no existe) y líneas de log
+# estructuradas por petición
+app.config['METRICS_TOKEN'] = os.environ.get("METRICS_TOKEN")
+app.config['LOG_METRICAS'] = os.environ.get("LOG_METRICAS", "1") == "1"
+class SesionEnrutada(Session):
+    """Sesión que envía a la réplica los SELECT hechos dentro de `leer_de_replica()`.
+
+    Todo lo demás (flush, UPDATE/DELETE masivos, SQL textual y lecturas sin marcar)
+    va a la primaria. Sin DATABASE_REPLICA_URL se comporta como la sesión normal.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and isinstance(clause, Select) and has_app_context()
+                and g.get('leer_de_replica') and 'replica' in self._db.engines):
+            return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(app, session_options={"class_": SesionEnrutada})
+
+@contextmanager
+def leer_de_replica():
+    """Las consultas del bloque pueden leer datos con el retraso de replicación."""
+    previo = g.get('leer_de_replica', False)
+    g.leer_de_replica = True
+    try:
+        yield
+    finally:
+        g.leer_de_replica = previo
+
+def _incluir_en_migraciones(objeto, nombre, tipo, reflejado, comparado_con):
+    # Las tablas internas de FTS5 (SQLite) se gestionan a mano en su migración
+    return not (tipo == 'table' and nombre.startswith('document_chunk_fts'))
+
+migrate = Migrate(app, db, include_object=_incluir_en_migraciones)
 
 # Configuración de Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+##############################################
+# Instrumentación y métricas                 #
+##############################################
+
+# Con varios workers de gunicorn, PROMETHEUS_MULTIPROC_DIR hace que /metrics agregue
+# los valores de todos los procesos (ver gunicorn.conf.py)
+METRICA_PETICION = Histogram(
+    'profai_peticion_segundos', 'Latencia total por endpoint', ['endpoint', 'metodo', 'estado']
+)
+METRICA_ETAPA = Histogram(
+    'profai_etapa_segundos', 'Duración de cada etapa del procesamiento', ['endpoint', 'etapa'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+METRICA_TOKENS = Histogram(
+    'profai_tokens_por_llamada', 'Tokens enviados y recibidos por llamada al modelo', ['direccion'],
+    buckets=(100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+)
+METRICA_CONSULTAS_DB = Histogram(
+    'profai_consultas_db_por_peticion', 'Consultas SQL ejecutadas por petición', ['endpoint'],
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+)
+METRICA_EXTRACCION = Histogram(
+    'profai_extraccion_segundos', 'Tiempo de extracción de texto por tipo de archivo', ['tipo'],
+    buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+
+logger_metricas = logging.getLogger('profai.metricas')
+if not logger_metricas.handlers:
+    logger_metricas.addHandler(logging.StreamHandler())
+    logger_metricas.setLevel(logging.INFO)
+    logger_metricas.propagate = False
+
+def _endpoint_actual():
+    return request.endpoint or 'desconocido' if has_request_context() else 'segundo_plano'
+
+@contextmanager
+def medir(etapa):
+    """Mide una etapa del procesamiento y la registra en la petición en curso."""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        duracion = time.perf_counter() - inicio
+        METRICA_ETAPA.labels(_endpoint_actual(), etapa).observe(duracion)
+        if has_request_context() and 'etapas' in g:
+            g.etapas[etapa] = round(duracion * 1000, 2)
+
+def registrar_tokens(uso):
+    if uso is None:
+        return
+    METRICA_TOKENS.labels('entrada').observe(uso.prompt_tokens)
+    METRICA_TOKENS.labels('salida').observe(uso.completion_tokens)
+    if has_request_context() and 'etapas' in g:
+        g.tokens = {"entrada": uso.prompt_tokens, "salida": uso.completion_tokens}
+
+def registrar_linea(evento, **campos):
+    """Línea de log JSON con las etapas, consultas y tokens de la petición en curso."""
+    if not app.config['LOG_METRICAS']:
+        return
+    if has_request_context() and 'etapas' in g:
+        campos.setdefault('endpoint', request.endpoint)
+        campos.update(etapas_ms=g.etapas, consultas_db=g.consultas_db, tokens=g.get('tokens'))
+    logger_metricas.info(json.dumps({"evento": evento, **campos}, ensure_ascii=False, default=str))
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _contar_consulta(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'consultas_db' in g:
+        g.consultas_db += 1
+
+@app.before_request
+def _iniciar_medicion():
+    g.inicio_peticion = time.perf_counter()
+    g.consultas_db = 0
+    g.etapas = {}
+
+@app.after_request
+def _registrar_peticion(response):
+    if 'inicio_peticion' not in g or request.endpoint in (None, 'static', 'metrics'):
+        return response
+    duracion = time.perf_counter() - g.inicio_peticion
+    METRICA_PETICION.labels(request.endpoint, request.method, response.status_code).observe(duracion)
+    METRICA_CONSULTAS_DB.labels(request.endpoint).observe(g.consultas_db)
+    # Las respuestas en streaming registran su propia línea al terminar
+    if not response.is_streamed:
+        registrar_linea('peticion', estado=response.status_code, duracion_ms=round(duracion * 1000, 2))
+    return response
+
 ##############################################
 # Modelos de Base de Datos                   #
 ##############################################
@@ -58,27 +340,166 @@ class User(db.Model, UserMixin):
     username = db.Column(db.String(150), unique=True, nullable=False)
     password = db.Column(db.String(255), nullable=False)  # Hash de la contraseña
     memory_mode = db.Column(db.Boolean, default=False)  # Nuevo campo para modo memoria
+    prompt_template = db.Column(db.String(100), nullable=True)  # Prompt propio; None usa el global
     messages = db.relationship('Message', backref='user', lazy=True)
 
 class Message(db.Model):
+    # Todas las consultas calientes filtran por usuario y ordenan por fecha
+    __table_args__ = (
+        db.Index('ix_message_user_id_timestamp', 'user_id', 'timestamp'),
+        db.Index('ix_message_user_id_role_timestamp', 'user_id', 'role', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     role = db.Column(db.String(50), nullable=False)
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
 
+class PromptTemplate(db.Model):
+    __tablename__ = 'prompt_template'
+    __table_args__ = (db.UniqueConstraint('name', 'version'),)
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UploadJob(db.Model):
+    __tablename__ = 'upload_job'
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 en hexadecimal
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pendiente')  # pendiente, procesando, listo, error
+    pages_total = db.Column(db.Integer, nullable=True)
+    pages_done = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class DocumentBlob(db.Model):
+    # Archivo subido, identificado por el SHA-256 de sus bytes y compartido entre usuarios
+    __tablename__ = 'document_blob'
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), unique=True, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)  # Filas de user_document que lo usan
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UserDocument(db.Model):
+    __tablename__ = 'user_document'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    blob_id = db.Column(db.Integer, db.ForeignKey('document_blob.id'), nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class DocumentChunk(db.Model):
+    __tablename__ = 'document_chunk'
+    __table_args__ = (
+        # Índice léxico en Postgres; en SQLite se usa la tabla FTS5 creada más abajo
+        db.Index(
+            'ix_document_chunk_tsv',
+            db.func.to_tsvector('spanish', db.text('content')),
+            postgresql_using='gin'
+        ).ddl_if(dialect='postgresql'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    blob_id = db.Column(db.Integer, db.ForeignKey('document_blob.id'), nullable=False, index=True)
+    position = db.Column(db.Integer, nullable=False)  # Orden del fragmento dentro del archivo
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Tabla FTS5 (contenido externo) sincronizada con document_chunk mediante triggers
+SQLITE_FTS_FRAGMENTOS = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS document_chunk_fts USING fts5("
+    "content, content='document_chunk', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS document_chunk_ai AFTER INSERT ON document_chunk BEGIN "
+    "INSERT INTO document_chunk_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS document_chunk_ad AFTER DELETE ON document_chunk BEGIN "
+    "INSERT INTO document_chunk_fts(document_chunk_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+]
+for _sentencia in SQLITE_FTS_FRAGMENTOS:
+    event.listen(DocumentChunk.__table__, 'after_create', DDL(_sentencia).execute_if(dialect='sqlite'))
+
+class LLMResponseCache(db.Model):
+    __tablename__ = 'llm_response_cache'
+    key = db.Column(db.String(64), primary_key=True)  # Huella SHA-256 de la petición
+    response = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class KeyPoint(db.Model):
+    # Secciones "### Punto clave" extraídas de las respuestas al guardarlas, para /resumen
+    __tablename__ = 'key_point'
+    __table_args__ = (
+        db.Index('ix_key_point_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # None cuando el mensaje de origen ya se movió a message_archive
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=True, index=True)
+    content = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ConversationSummary(db.Model):
+    __tablename__ = 'conversation_summary'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), unique=True, nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    last_message_id = db.Column(db.Integer, nullable=False, default=0)  # Último mensaje ya resumido
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class MessageArchive(db.Model):
+    # Mensajes antiguos sacados de `message` por `flask archivar-mensajes`: cada fila es
+    # un lote de un usuario en JSONL comprimido, para que la tabla caliente no crezca
+    __tablename__ = 'message_archive'
+    __table_args__ = (
+        db.Index('ix_message_archive_user_id_first_message_id', 'user_id', 'first_message_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    first_message_id = db.Column(db.Integer, nullable=False)
+    last_message_id = db.Column(db.Integer, nullable=False)
+    message_count = db.Column(db.Integer, nullable=False)
+    oldest = db.Column(db.DateTime, nullable=True)
+    newest = db.Column(db.DateTime, nullable=True)
+    codec = db.Column(db.String(10), nullable=False)  # 'zstd' o 'zlib'
+    payload = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 ##############################################
 # Configuración de Flask-Login               #
 ##############################################
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    campos = usuario_en_cache(user_id)
+    if campos and coincide_con_sesion(campos):
+        # Se incorpora a la sesión de SQLAlchemy sin consultar la base; los campos que
+        # no están en caché (p. ej. password) se cargan solo si algo los usa
+        user = User(**{campo: campos[campo] for campo in CAMPOS_USUARIO_CACHE})
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    with leer_de_replica():
+        user = db.session.get(User, user_id)
+    # Un usuario recién registrado, o recién modificado, puede no haber llegado aún a la réplica
+    if user is None or not coincide_con_sesion({campo: getattr(user, campo) for campo in CAMPOS_USUARIO_MUTABLES}):
+        user = db.session.get(User, user_id, populate_existing=True)
+    if user:
+        recordar_usuario(user)
+    return user
 
 ##############################################
 # Constantes y Configuraciones               #
 ##############################################
 
+MODELO_CHAT = "gpt-4o-mini"
+PROMPT_SISTEMA_GLOBAL = 'sistema'
+TEMPERATURA_CHAT = 0.7
+# Comandos cuya respuesta depende solo del prompt y puede reutilizarse entre alumnos
+COMANDOS_CACHEABLES = {'/help', '/example', '/exercise'}
 COMANDOS_VALIDOS = ['/clear', '/example', '/exercise', '/summary', '/help', '/explicar']
 system_prompt_content = (
     "Eres un profesor experto que adapta explicaciones usando ejemplos prácticos y preguntas interactivas. "
@@ -107,11 +528,940 @@ def allowed_file(filename):
 # Funciones Auxiliares                       #
 ##############################################
 
+# El frontend inserta las respuestas con innerHTML después de convertir el markdown
+# (processContent en index.html). Todo lo peligroso se neutraliza escapándolo, nunca
+# borrándolo: borrar permite que los restos se recombinen (`<scr<script></script>ipt>`).
+#  - `<` que abre una etiqueta, cierre o comentario -> `&lt;` (cubre <script type=...>,
+#    <img onerror=...>, <svg onload=...>, <iframe>, etc.)
+#  - imágenes markdown `![alt](url)`, que processContent convierte en <img src alt>:
+#    comillas y ángulos escapados para que no se pueda salir del atributo
+#  - esquemas javascript:/vbscript: -> `&#58;` en lugar de los dos puntos
+# Cada patrón empieza por un carácter literal (`!`, `<`, `:`) para que el motor salte
+# directo a los candidatos; con IGNORECASE, `(?:java|vb)script:` probaba cada posición.
+# Solo las imágenes necesitan una función; etiquetas y esquemas se reemplazan en C.
+_IMAGEN = re.compile(r'!\[[^\n]*?\]\([^\n]*?\)')
+_ETIQUETA = re.compile(r'<(?=[a-z/!?])', re.IGNORECASE)
+_ESQUEMA = re.compile(r':(?:(?<=javascript:)|(?<=vbscript:))', re.IGNORECASE)
+_ESCAPES_IMAGEN = str.maketrans({'"': '&quot;', "'": '&#39;', '<': '&lt;', '>': '&gt;'})
+ESQUEMAS_PELIGROSOS = ('javascript:', 'vbscript:')
+# Cola del texto que todavía puede convertirse en uno de los esquemas: j, ja, jav, ...
+_PREFIJO_ESQUEMA = re.compile(
+    '(?:' + '|'.join(
+        re.escape(esquema[:n]) for esquema in ESQUEMAS_PELIGROSOS for n in range(len(esquema) - 1, 0, -1)
+    ) + r')\Z',
+    re.IGNORECASE
+)
+IMAGEN_PENDIENTE_MAX = 4096  # Caracteres que el stream retiene esperando el cierre de ![...](...)
+
+def _neutralizar_imagen(coincidencia):
+    return _ESQUEMA.sub('&#58;', coincidencia.group().translate(_ESCAPES_IMAGEN))
+
 def sanitizar_markdown(texto):
-    texto = re.sub(r'<script>.*?</script>', '', texto, flags=re.DOTALL)
-    texto = re.sub(r'javascript:', '', texto, flags=re.IGNORECASE)
+    """Neutraliza lo peligroso antes de mandar el texto al navegador; ver el comentario de arriba.
+
+    Las imágenes van primero: dentro de ellas ya no queda ningún `<` ni `:` de esquema
+    que las pasadas siguientes puedan tocar. Un texto sin candidatos sale sin recorrerse.
+    """
+    if '![' in texto:
+        texto = _IMAGEN.sub(_neutralizar_imagen, texto)
+    if '<' in texto:
+        texto = _ETIQUETA.sub('&lt;', texto)
+    if ':' in texto:
+        texto = _ESQUEMA.sub('&#58;', texto)
     return texto
 
+def _corte_seguro(texto):
+    """Posición hasta la cual `texto` puede sanitizarse sin cortar un patrón a medias.
+
+    Solo mira la cola: un `<` o `!` final, un prefijo de esquema y una imagen
+    markdown abierta en la última línea.
+    """
+    corte = len(texto)
+    if texto.endswith(('<', '!')):
+        corte -= 1
+    prefijo = _PREFIJO_ESQUEMA.search(texto, max(0, len(texto) - len(max(ESQUEMAS_PELIGROSOS, key=len))))
+    if prefijo:
+        corte = min(corte, prefijo.start())
+    inicio = texto.find('![', texto.rfind('\n') + 1)
+    while inicio != -1:
+        completa = _IMAGEN.match(texto, inicio)
+        if completa is None:
+            corte = min(corte, inicio)
+            break
+        inicio = texto.find('![', completa.end())
+    # Si el corte deja un `<` al final, decidir si abre etiqueta depende del siguiente carácter
+    if corte and texto[corte - 1] == '<':
+        corte -= 1
+    return corte
+
+class SanitizadorStream:
+    """Sanitiza una respuesta que llega por partes sin volver a recorrer lo ya emitido.
+
+    Concatenar lo que devuelve `alimentar` y `cerrar` da lo mismo que
+    `sanitizar_markdown` sobre el texto completo.
+    """
+
+    def __init__(self):
+        self._pendiente = ""
+
+    def alimentar(self, fragmento):
+        texto = self._pendiente + fragmento
+        corte = _corte_seguro(texto)
+        if len(texto) - corte > IMAGEN_PENDIENTE_MAX:
+            # Una imagen que no se cierra nunca no puede frenar el stream: se anula su `!`
+            texto = texto[:corte] + '&#33;' + texto[corte + 1:]
+            corte = _corte_seguro(texto)
+        self._pendiente = texto[corte:]
+        return sanitizar_markdown(texto[:corte])
+
+    def cerrar(self):
+        texto, self._pendiente = self._pendiente, ""
+        return sanitizar_markdown(texto)
+
+def sanitizar_stream(fragmentos):
+    """Sanitiza una respuesta que llega por partes, emitiendo solo texto ya seguro."""
+    sanitizador = SanitizadorStream()
+    for fragmento in fragmentos:
+        seguro = sanitizador.alimentar(fragmento)
+        if seguro:
+            yield seguro
+    final = sanitizador.cerrar()
+    if final:
+        yield final
+
+@lru_cache(maxsize=1)
+def _codificador_tokens():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(MODELO_CHAT)
+    except Exception as e:
+        app.logger.warning(f"tiktoken no disponible, se estiman los tokens: {e}")
+        return None
+
+def contar_tokens(texto):
+    codificador = _codificador_tokens()
+    if codificador is None:
+        return len(texto) // 4 + 1  # ~4 caracteres por token
+    return len(codificador.encode(texto, disallowed_special=()))
+
+def recortar_tokens(texto, max_tokens):
+    codificador = _codificador_tokens()
+    if codificador is None:
+        return texto[:max_tokens * 4]
+    return codificador.decode(codificador.encode(texto, disallowed_special=())[:max_tokens])
+
+_cache_prompts = {}
+
+def obtener_prompt_sistema(nombre=None):
+    """Contenido de la última versión de una plantilla de prompt, cacheado en el proceso.
+
+    Sin plantilla en la base de datos, el prompt global es `system_prompt_content`.
+    """
+    nombre = nombre or PROMPT_SISTEMA_GLOBAL
+    en_cache = _cache_prompts.get(nombre)
+    if en_cache and en_cache[0] > time.monotonic():
+        return en_cache[1]
+
+    plantilla = PromptTemplate.query.filter_by(name=nombre).order_by(PromptTemplate.version.desc()).first()
+    if plantilla:
+        contenido = plantilla.content
+    elif nombre != PROMPT_SISTEMA_GLOBAL:
+        app.logger.warning(f"Plantilla de prompt inexistente: {nombre}; se usa la global")
+        return obtener_prompt_sistema()
+    else:
+        contenido = system_prompt_content
+    _cache_prompts[nombre] = (time.monotonic() + app.config['PROMPT_CACHE_TTL'], contenido)
+    return contenido
+
+def construir_contexto(user_id, prompt_sistema, presupuesto=None, turno_actual=None):
+    """Historial para el modo memoria acotado a un presupuesto de tokens.
+
+    Incluye el prompt de sistema, el resumen continuo (si existe) y luego recorre
+    los mensajes no resumidos del más reciente al más antiguo, agregando los que
+    entren en el presupuesto. Solo se leen como máximo MEMORIA_FILAS_MAX filas,
+    nunca el historial completo. `turno_actual` es el mensaje del alumno que aún
+    no se guardó; va al final y siempre se envía.
+    """
+    presupuesto = presupuesto or app.config['MEMORIA_TOKENS_MAX']
+    resumen_previo = ConversationSummary.query.filter_by(user_id=user_id).first()
+
+    restante = presupuesto - contar_tokens(prompt_sistema)
+    consulta = Message.query.filter(Message.user_id == user_id)
+    if resumen_previo:
+        # Lo ya resumido viaja dentro del resumen; solo se leen los mensajes posteriores
+        resumen_previo_msg = {
+            "role": "system",
+            "content": f"Resumen de la conversación previa con el alumno:\n{resumen_previo.content}"
+        }
+        restante -= contar_tokens(resumen_previo_msg["content"])
+        consulta = consulta.filter(Message.id > resumen_previo.last_message_id)
+
+    recientes = []
+    if turno_actual is not None:
+        costo = contar_tokens(turno_actual) + 4
+        recientes.append({"role": "user", "content": turno_actual if costo <= restante else recortar_tokens(
+            turno_actual, max(restante - 4, 0)
+        )})
+        restante -= costo
+
+    filas = consulta.order_by(Message.timestamp.desc(), Message.id.desc()).limit(app.config['MEMORIA_FILAS_MAX'])
+    for msg in filas.yield_per(50) if restante > 0 else ():
+        costo = contar_tokens(msg.content) + 4  # sobrecosto por mensaje del formato de chat
+        if costo > restante:
+            if not recientes:
+                # El turno actual siempre se envía, recortado si hace falta
+                recientes.append({"role": msg.role, "content": recortar_tokens(msg.content, max(restante - 4, 0))})
+                break
+            # Mensajes enormes (p. ej. archivos completos) se omiten sin cortar el resto del historial
+            continue
+        recientes.append({"role": msg.role, "content": msg.content})
+        restante -= costo
+        if restante <= 0:
+            break
+
+    mensajes = [{"role": "system", "content": prompt_sistema}]
+    if resumen_previo:
+        mensajes.append(resumen_previo_msg)
+    mensajes.extend(reversed(recientes))
+    return mensajes
+
+def dividir_en_fragmentos(texto, max_caracteres=None):
+    """Parte un texto en fragmentos de hasta `max_caracteres`, respetando los párrafos."""
+    max_caracteres = max_caracteres or app.config['FRAGMENTO_CARACTERES']
+    fragmentos, actual, largo = [], [], 0
+    for parrafo in texto.split("\n"):
+        while len(parrafo) > max_caracteres:
+            fragmentos.append(parrafo[:max_caracteres])
+            parrafo = parrafo[max_caracteres:]
+        if actual and largo + len(parrafo) > max_caracteres:
+            fragmentos.append("\n".join(actual))
+            actual, largo = [], 0
+        actual.append(parrafo)
+        largo += len(parrafo) + 1
+    if "".join(actual).strip():
+        fragmentos.append("\n".join(actual))
+    return [fragmento for fragmento in fragmentos if fragmento.strip()]
+
+# Palabras tan frecuentes que coinciden con casi todos los fragmentos y solo encarecen la búsqueda
+PALABRAS_VACIAS = frozenset((
+    "los las del que por para con una uno unos unas como más pero sus este esta estos estas ese esa "
+    "eso son fue ser hay muy sin sobre entre cuando también desde todo todos nos les qué cómo cuál "
+    "explica explícame explicame dime puedes favor tema ejemplo ejemplos ejercicio hola gracias"
+).split())
+
+def buscar_fragmentos(user_id, consulta, k=None):
+    """Los `k` fragmentos de los archivos del usuario más relevantes para `consulta`.
+
+    Devuelve pares (nombre de archivo, fragmento). Usa FTS5 (bm25) en SQLite y
+    tsvector/ts_rank en Postgres.
+    """
+    k = k or app.config['FRAGMENTOS_POR_TURNO']
+    terminos = list(dict.fromkeys(
+        t for t in (t.lower() for t in re.findall(r'\w{3,}', consulta)) if t not in PALABRAS_VACIAS
+    ))[:32]
+    if not terminos:
+        return []
+
+    nombres = {doc.blob_id: doc.filename for doc in UserDocument.query.filter_by(user_id=user_id)}
+    if not nombres:
+        return []
+
+    blobs_usuario = "SELECT blob_id FROM user_document WHERE user_id = :user_id"
+    if db.engine.dialect.name == 'sqlite':
+        filas = db.session.execute(text(
+            "SELECT c.id FROM document_chunk_fts f JOIN document_chunk c ON c.id = f.rowid "
+            f"WHERE document_chunk_fts MATCH :consulta AND c.blob_id IN ({blobs_usuario}) "
+            "ORDER BY bm25(document_chunk_fts) LIMIT :k"
+        ), {"consulta": " OR ".join(f'"{t}"' for t in terminos), "user_id": user_id, "k": k})
+    else:
+        filas = db.session.execute(text(
+            f"SELECT id FROM document_chunk WHERE blob_id IN ({blobs_usuario}) "
+            "AND to_tsvector('spanish', content) @@ to_tsquery('spanish', :consulta) "
+            "ORDER BY ts_rank(to_tsvector('spanish', content), to_tsquery('spanish', :consulta)) DESC LIMIT :k"
+        ), {"consulta": " | ".join(terminos), "user_id": user_id, "k": k})
+    ids = [fila.id for fila in filas]
+    if not ids:
+        return []
+    por_id = {fragmento.id: fragmento for fragmento in DocumentChunk.query.filter(DocumentChunk.id.in_(ids))}
+    return [(nombres[por_id[i].blob_id], por_id[i]) for i in ids]
+
+def liberar_documentos(user_id):
+    """Desvincula los archivos del usuario y borra los blobs que ya nadie usa.
+
+    No hace commit; el llamador decide cuándo confirmar.
+    """
+    blob_ids = [doc.blob_id for doc in UserDocument.query.filter_by(user_id=user_id)]
+    if not blob_ids:
+        return
+    UserDocument.query.filter_by(user_id=user_id).delete()
+    for blob_id in blob_ids:
+        DocumentBlob.query.filter_by(id=blob_id).update({DocumentBlob.ref_count: DocumentBlob.ref_count - 1})
+    huerfanos = [blob.id for blob in DocumentBlob.query.filter(
+        DocumentBlob.id.in_(blob_ids), DocumentBlob.ref_count <= 0
+    )]
+    if huerfanos:
+        DocumentChunk.query.filter(DocumentChunk.blob_id.in_(huerfanos)).delete(synchronize_session=False)
+        DocumentBlob.query.filter(DocumentBlob.id.in_(huerfanos)).delete(synchronize_session=False)
+
+PATRON_PUNTO_CLAVE = re.compile(r'### Punto clave.*?(?=^#{1,3} |\Z)', re.MULTILINE | re.DOTALL)
+
+def extraer_puntos_clave(texto):
+    return [punto.strip() for punto in PATRON_PUNTO_CLAVE.findall(texto)]
+
+def agregar_puntos_clave(msg):
+    """Registra los puntos clave de un mensaje del asistente ya agregado a la sesión."""
+    puntos = extraer_puntos_clave(msg.content)
+    if puntos:
+        db.session.flush()  # Para conocer msg.id
+        db.session.add_all(
+            KeyPoint(user_id=msg.user_id, message_id=msg.id, content=punto, timestamp=msg.timestamp)
+            for punto in puntos
+        )
+
+@contextmanager
+def unidad_de_trabajo():
+    """Agrupa las escrituras del bloque en un único commit al salir.
+
+    Los bloques anidados se suman al exterior; dentro de uno, `confirmar()` no
+    hace commit. Si el bloque falla se descarta todo lo pendiente.
+    """
+    profundidad = g.get('unidad_de_trabajo', 0)
+    if profundidad == 0:
+        g.al_confirmar = []
+    g.unidad_de_trabajo = profundidad + 1
+    try:
+        yield
+        if profundidad == 0:
+            db.session.commit()
+            for funcion in g.al_confirmar:
+                funcion()
+    except Exception:
+        if profundidad == 0:
+            db.session.rollback()
+        raise
+    finally:
+        g.unidad_de_trabajo = profundidad
+
+def confirmar():
+    """Commit inmediato, salvo dentro de una unidad de trabajo: ahí se confirma al final."""
+    if not g.get('unidad_de_trabajo', 0):
+        db.session.commit()
+
+def liberar_conexion():
+    """Cierra la transacción en curso antes de una espera larga (p. ej. la llamada al modelo).
+
+    Con gevent un worker atiende decenas de chats a la vez: si cada uno retuviera su
+    conexión mientras espera a OpenAI, el pool se agotaría y /login o /export harían
+    cola en pool_timeout. La próxima consulta abre una transacción nueva y corta.
+    """
+    db.session.commit()
+
+def al_confirmar(funcion):
+    """Ejecuta `funcion` tras el commit de la unidad de trabajo en curso, o ya si no hay una."""
+    if g.get('unidad_de_trabajo', 0):
+        g.al_confirmar.append(funcion)
+    else:
+        funcion()
+
+def guardar_turno(user_id, pregunta, respuesta, recibido):
+    """Persiste la pregunta del alumno y la respuesta del asistente con sus puntos clave.
+
+    `respuesta` en None guarda solo la pregunta (p. ej. si el modelo falló). Con
+    ESCRITURA_DIFERIDA los mensajes viajan al buffer de escritura en lugar de la sesión.
+    """
+    filas = [{"user_id": user_id, "role": 'user', "content": pregunta, "timestamp": recibido}]
+    if respuesta is not None:
+        filas.append({"user_id": user_id, "role": 'assistant', "content": respuesta, "timestamp": datetime.utcnow()})
+
+    if app.config['ESCRITURA_DIFERIDA']:
+        pendiente = _buffer_mensajes.agregar(filas)
+        if app.config['ESCRITURA_DIFERIDA'] == 'grupo':
+            # Se espera después del commit, con la conexión ya devuelta al pool: si
+            # cientos de peticiones esperaran reteniéndola, el escritor no tendría una
+            al_confirmar(pendiente.result)
+        return
+
+    mensajes = [Message(**fila) for fila in filas]
+    db.session.add_all(mensajes)
+    if respuesta is not None:
+        agregar_puntos_clave(mensajes[-1])
+    confirmar()
+
+def completar_chat(mensajes, stream=False, max_tokens=15000, temperature=TEMPERATURA_CHAT, user_id=None):
+    """Punto único de salida hacia el modelo; todas las rutas pasan por aquí.
+
+    Cada llamada espera su turno en el planificador, que reparte la concurrencia y
+    el presupuesto de tokens entre usuarios. En streaming el turno se ocupa hasta
+    consumir el último chunk.
+    """
+    estimados = sum(contar_tokens(m["content"]) + 4 for m in mensajes) + min(
+        max_tokens, app.config['OPENAI_SALIDA_ESTIMADA']
+    )
+    parametros = dict(model=MODELO_CHAT, messages=mensajes, max_tokens=max_tokens, temperature=temperature)
+
+    if not stream:
+        with _planificador.turno(user_id, estimados):
+            response = _crear_con_reintentos(**parametros)
+        registrar_tokens(response.usage)
+        _planificador.ajustar(response.usage, estimados)
+        return response
+
+    def con_uso():
+        with _planificador.turno(user_id, estimados):
+            chunks = _crear_con_reintentos(stream=True, stream_options={"include_usage": True}, **parametros)
+            # Con include_usage el último chunk trae el conteo de tokens y no tiene choices
+            for chunk in chunks:
+                uso = getattr(chunk, 'usage', None)
+                if uso is not None:
+                    registrar_tokens(uso)
+                    _planificador.ajustar(uso, estimados)
+                yield chunk
+
+    return con_uso()
+
+_cliente = None
+_cliente_lock = threading.Lock()
+
+def _cliente_openai():
+    """El cliente de OpenAI del proceso, sin los reintentos del SDK.
+
+    Si el SDK reintentara los 429 por su cuenta, el planificador no se enteraría
+    y no frenaría al resto de las llamadas. Se crea en el primer uso para que la
+    aplicación arranque (migraciones, comandos flask) sin OPENAI_API_KEY.
+    """
+    global _cliente
+    with _cliente_lock:
+        if _cliente is None:
+            _cliente = openai.OpenAI(
+                api_key=os.environ.get("OPENAI_API_KEY"),
+                timeout=OPENAI_TIMEOUT,
+                max_retries=0
+            )
+        return _cliente
+
+def _crear_con_reintentos(**parametros):
+    """Llama a la API y, ante un 429, frena todo el despacho con backoff exponencial.
+
+    Los errores de red y 5xx se reintentan hasta OPENAI_MAX_RETRIES veces, como hacía
+    el SDK, pero sin frenar a las demás llamadas.
+    """
+    reintentos_429 = reintentos_red = 0
+    while True:
+        try:
+            return _cliente_openai().chat.completions.create(**parametros)
+        except openai.RateLimitError:
+            if reintentos_429 == app.config['OPENAI_REINTENTOS_429']:
+                raise
+            espera = min(60, 2 ** reintentos_429) * random.uniform(0.5, 1)
+            reintentos_429 += 1
+            app.logger.warning(f"OpenAI respondió 429; reintento {reintentos_429} en {espera:.1f} s")
+            _planificador.frenar(espera)
+            time.sleep(espera)
+        except (openai.APIConnectionError, openai.InternalServerError) as e:
+            if reintentos_red == OPENAI_MAX_RETRIES:
+                raise
+            espera = min(8, 0.5 * 2 ** reintentos_red) * random.uniform(0.5, 1)
+            reintentos_red += 1
+            app.logger.warning(f"Error de OpenAI ({e.__class__.__name__}); reintento {reintentos_red} en {espera:.1f} s")
+            time.sleep(espera)
+
+class CacheLRU:
+    """Caché en memoria con expiración y desalojo LRU, segura entre hilos."""
+
+    def __init__(self, max_entradas, ttl):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, clave):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                return None
+            if entrada[0] <= time.monotonic():
+                del self._datos[clave]
+                return None
+            self._datos.move_to_end(clave)
+            return entrada[1]
+
+    def set(self, clave, valor, ttl=None):
+        with self._lock:
+            self._datos[clave] = (time.monotonic() + (ttl or self.ttl), valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+
+    def pop(self, clave):
+        with self._lock:
+            self._datos.pop(clave, None)
+
+##############################################
+# Planificador de llamadas al modelo         #
+##############################################
+
+class PlanificadorOpenAI:
+    """Cola justa delante de la API de OpenAI.
+
+    - Como máximo `por_usuario` llamadas simultáneas por usuario y `globales` en total.
+    - Presupuesto de tokens por minuto: cada llamada reserva una estimación al
+      empezar y se corrige con el uso real al terminar.
+    - Los usuarios con llamadas en espera se atienden por turnos (round robin), así
+      que quien manda muchas a la vez no deja sin servicio al resto.
+    - `frenar` pausa todo el despacho tras un 429.
+    """
+
+    def __init__(self, por_usuario, globales, tpm, espera_max):
+        self.por_usuario = por_usuario
+        self.globales = globales
+        self.tpm = tpm
+        self.espera_max = espera_max
+        self._lock = threading.Lock()
+        self._colas = {}       # usuario -> turnos en espera (FIFO)
+        self._ronda = deque()  # usuarios con turnos en espera, en orden de atención
+        self._activas = {}
+        self._total = 0
+        self._tokens = float(tpm)
+        self._recargado = time.monotonic()
+        self._pausa_hasta = 0.0
+
+    def _despachar(self):
+        ahora = time.monotonic()
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + (ahora - self._recargado) * self.tpm / 60)
+            self._recargado = ahora
+        if ahora < self._pausa_hasta:
+            return
+
+        sin_cupo = 0
+        while self._ronda and sin_cupo < len(self._ronda) and self._total < self.globales:
+            usuario = self._ronda[0]
+            if self._activas.get(usuario, 0) >= self.por_usuario:
+                self._ronda.rotate(-1)
+                sin_cupo += 1
+                continue
+            turno = self._colas[usuario][0]
+            if self.tpm and self._tokens < min(turno.tokens, self.tpm):
+                return  # El resto espera a que se recargue el presupuesto, sin adelantarse
+
+            self._colas[usuario].popleft()
+            self._ronda.popleft()
+            if self._colas[usuario]:
+                self._ronda.append(usuario)
+            else:
+                del self._colas[usuario]
+            self._activas[usuario] = self._activas.get(usuario, 0) + 1
+            self._total += 1
+            self._tokens -= turno.tokens
+            turno.listo.set()
+            sin_cupo = 0
+
+    @contextmanager
+    def turno(self, usuario, tokens):
+        turno = SimpleNamespace(tokens=tokens, listo=threading.Event())
+        with self._lock:
+            self._colas.setdefault(usuario, deque()).append(turno)
+            if len(self._colas[usuario]) == 1:
+                self._ronda.append(usuario)
+            self._despachar()
+
+        limite = time.monotonic() + self.espera_max
+        with medir('cola_openai'):
+            # Se reintenta el despacho periódicamente por la recarga del presupuesto y las pausas
+            while not turno.listo.wait(0.1):
+                with self._lock:
+                    if turno.listo.is_set():
+                        break
+                    if time.monotonic() > limite:
+                        self._colas[usuario].remove(turno)
+                        if not self._colas[usuario]:
+                            del self._colas[usuario]
+                            self._ronda.remove(usuario)
+                        raise TimeoutError("Demasiadas llamadas a OpenAI en espera")
+                    self._despachar()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._activas[usuario] -= 1
+                if not self._activas[usuario]:
+                    del self._activas[usuario]
+                self._total -= 1
+                self._despachar()
+
+    def ajustar(self, uso, estimados):
+        if self.tpm:
+            with self._lock:
+                self._tokens -= uso.prompt_tokens + uso.completion_tokens - estimados
+
+    def frenar(self, segundos):
+        with self._lock:
+            self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+
+_planificador = PlanificadorOpenAI(
+    app.config['OPENAI_CONCURRENCIA_USUARIO'],
+    app.config['OPENAI_CONCURRENCIA_GLOBAL'],
+    app.config['OPENAI_TPM'],
+    app.config['OPENAI_ESPERA_MAX']
+)
+
+# Turnos de chat en curso por (usuario, mensaje): un doble envío espera al primero
+_turnos_en_curso = {}
+_turnos_lock = threading.Lock()
+
+def unirse_a_turno(user_id, user_message):
+    """Devuelve (Future con la respuesta, True si esta petición debe generarla)."""
+    clave = (user_id, user_message)
+    with _turnos_lock:
+        turno = _turnos_en_curso.get(clave)
+        if turno is not None:
+            return turno, False
+        turno = _turnos_en_curso[clave] = Future()
+
+    def soltar(_):
+        with _turnos_lock:
+            if _turnos_en_curso.get(clave) is turno:
+                del _turnos_en_curso[clave]
+
+    turno.add_done_callback(soltar)
+    return turno, True
+
+def terminar_turno(turno, respuesta=None, error=None):
+    if turno.done():
+        return
+    if error is not None:
+        turno.set_exception(error)
+    else:
+        turno.set_result(respuesta)
+
+def respuesta_compartida(turno, stream):
+    """Respuesta para un envío duplicado: la misma que obtenga la petición original.
+
+    El turno resuelve con el texto crudo del modelo; se sanitiza aquí, al enviarlo.
+    """
+    espera = OPENAI_TIMEOUT + app.config['OPENAI_ESPERA_MAX']
+    liberar_conexion()
+    if not stream:
+        try:
+            return jsonify({"response": sanitizar_markdown(turno.result(timeout=espera))})
+        except Exception as e:
+            app.logger.error(f"Error en envío duplicado: {str(e)}")
+            return jsonify({"response": "⚠️ Error al procesar tu solicitud. Intenta nuevamente."}), 500
+
+    def generar():
+        try:
+            yield _evento_sse({"delta": sanitizar_markdown(turno.result(timeout=espera))})
+            yield _evento_sse({"done": True}, evento='done')
+        except Exception as e:
+            app.logger.error(f"Error en envío duplicado (stream): {str(e)}")
+            yield _evento_sse({"response": "⚠️ Error al procesar tu solicitud. Intenta nuevamente."}, evento='error')
+
+    response = Response(stream_with_context(generar()), mimetype='text/event-stream')
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+##############################################
+# Resumen continuo del historial             #
+##############################################
+
+PROMPT_RESUMEN = (
+    "Mantienes un resumen de la conversación entre un profesor y un alumno. "
+    "Recibirás el resumen actual y los mensajes nuevos. Devuelve el resumen actualizado, "
+    "conservando los temas vistos, el nivel y estilo de aprendizaje del alumno, sus dudas "
+    "y los archivos que subió. Sé conciso: como máximo 400 palabras."
+)
+
+_resumenes_en_curso = set()
+_resumenes_lock = threading.Lock()
+
+def actualizar_resumen(user_id):
+    """Pliega en el resumen del usuario los mensajes más antiguos que aún no cubre.
+
+    Solo procesa los mensajes posteriores a la marca `last_message_id`, dejando
+    fuera los RESUMEN_TURNOS_RECIENTES más nuevos, que se envían sin resumir. Sin
+    resumen previo la marca arranca RESUMEN_PLIEGUES_MAX pliegues antes de esos
+    recientes: activar la memoria con un historial largo no lo resume entero.
+    Devuelve True si el resumen cambió.
+    """
+    resumen_previo = ConversationSummary.query.filter_by(user_id=user_id).first()
+    base = Message.query.filter(Message.user_id == user_id, Message.role != 'system')
+    recientes = app.config['RESUMEN_TURNOS_RECIENTES']
+    if resumen_previo is not None:
+        marca = resumen_previo.last_message_id
+    else:
+        inicio = base.order_by(Message.id.desc()).offset(
+            recientes + app.config['RESUMEN_LOTE'] * app.config['RESUMEN_PLIEGUES_MAX']
+        ).first()
+        marca = inicio.id if inicio else 0
+
+    limite = base.order_by(Message.id.desc()).offset(recientes).first()
+    if limite is None or limite.id <= marca:
+        return False
+
+    pendientes = base.filter(
+        Message.id > marca,
+        Message.id <= limite.id
+    ).order_by(Message.id.asc()).limit(app.config['RESUMEN_LOTE']).all()
+    if not pendientes:
+        return False
+
+    nuevos = "\n\n".join(
+        f"{msg.role}: {recortar_tokens(msg.content, 1500)}" for msg in pendientes
+    )
+    contenido_previo = resumen_previo.content if resumen_previo else '(vacío)'
+    marca_previa = resumen_previo.last_message_id if resumen_previo else None
+    nueva_marca = pendientes[-1].id
+    # La llamada al modelo tarda segundos: la conexión vuelve al pool mientras tanto
+    liberar_conexion()
+    respuesta = completar_chat([
+        {"role": "system", "content": PROMPT_RESUMEN},
+        {"role": "user", "content": (
+            f"Resumen actual:\n{contenido_previo}\n\n"
+            f"Mensajes nuevos:\n{nuevos}"
+        )}
+    ], max_tokens=1000, temperature=0.3, user_id=user_id)
+
+    resumen = ConversationSummary.query.filter_by(user_id=user_id).first()
+    if (resumen.last_message_id if resumen else None) != marca_previa:
+        return False  # Otro worker actualizó el resumen mientras tanto
+    if resumen is None:
+        resumen = ConversationSummary(user_id=user_id)
+        db.session.add(resumen)
+    resumen.content = respuesta.choices[0].message.content
+    resumen.last_message_id = nueva_marca
+    db.session.commit()
+    return True
+
+def programar_resumen(user_id):
+    """Actualiza el resumen en segundo plano, sin bloquear la respuesta al alumno."""
+    with _resumenes_lock:
+        if user_id in _resumenes_en_curso:
+            return
+        _resumenes_en_curso.add(user_id)
+
+    def tarea():
+        try:
+            with app.app_context():
+                # Un historial atrasado se pone al día en unos pocos pliegues seguidos;
+                # lo que quede se sigue plegando en los próximos turnos
+                for _ in range(app.config['RESUMEN_PLIEGUES_MAX']):
+                    if not actualizar_resumen(user_id):
+                        break
+        except Exception as e:
+            app.logger.error(f"Error al actualizar el resumen: {str(e)}")
+        finally:
+            with _resumenes_lock:
+                _resumenes_en_curso.discard(user_id)
+
+    threading.Thread(target=tarea, daemon=True).start()
+
+##############################################
+# Caché de respuestas del modelo             #
+##############################################
+
+_cache_llm = CacheLRU(app.config['LLM_CACHE_MAX_MEMORIA'], app.config['LLM_CACHE_TTL'])
+METRICA_CACHE_LLM = Counter(
+    'profai_cache_llm_total', 'Consultas a la caché de respuestas del modelo según su resultado', ['resultado']
+)
+_inserciones_cache_llm = 0
+_inserciones_cache_llm_lock = threading.Lock()
+
+def clave_cache_llm(user_message, mensajes):
+    """Huella de la petición al modelo, o None si la respuesta no debe cachearse."""
+    if not app.config['LLM_CACHE'] or not user_message.startswith('/'):
+        return None
+    if user_message.split()[0].lower() not in COMANDOS_CACHEABLES:
+        return None
+    normalizados = [
+        {"role": m["role"], "content": " ".join(m["content"].split()).casefold()} for m in mensajes
+    ]
+    huella = json.dumps([MODELO_CHAT, TEMPERATURA_CHAT, normalizados], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(huella.encode('utf-8')).hexdigest()
+
+def cache_llm_obtener(clave):
+    """Busca primero en la caché del proceso y luego en la compartida (base de datos)."""
+    respuesta = _cache_llm.get(clave)
+    if respuesta is not None:
+        METRICA_CACHE_LLM.labels('acierto_memoria').inc()
+        return respuesta
+
+    ahora = datetime.utcnow()
+    fila = db.session.get(LLMResponseCache, clave)
+    if fila is None or fila.expires_at <= ahora:
+        METRICA_CACHE_LLM.labels('fallo').inc()
+        return None
+    # Se confirma junto con el resto de las escrituras de la petición
+    fila.last_used_at = ahora
+    _cache_llm.set(clave, fila.response, ttl=(fila.expires_at - ahora).total_seconds())
+    METRICA_CACHE_LLM.labels('acierto_compartida').inc()
+    return fila.response
+
+def cache_llm_guardar(clave, respuesta):
+    global _inserciones_cache_llm
+    ahora = datetime.utcnow()
+    _cache_llm.set(clave, respuesta)
+    db.session.merge(LLMResponseCache(
+        key=clave,
+        response=respuesta,
+        expires_at=ahora + timedelta(seconds=app.config['LLM_CACHE_TTL']),
+        last_used_at=ahora
+    ))
+    with _inserciones_cache_llm_lock:
+        _inserciones_cache_llm += 1
+        podar = _inserciones_cache_llm % app.config['LLM_CACHE_PODA_CADA'] == 0
+    if podar:
+        podar_cache_llm(ahora)
+    confirmar()
+
+def podar_cache_llm(ahora):
+    """Elimina las entradas vencidas y, si se superó LLM_CACHE_MAX_FILAS, las menos usadas.
+
+    Se poda hasta el 90% del máximo, para que la próxima poda tenga margen; entre
+    podas la tabla puede pasarse del máximo en unas pocas inserciones por worker.
+    """
+    LLMResponseCache.query.filter(LLMResponseCache.expires_at <= ahora).delete()
+    maximo = app.config['LLM_CACHE_MAX_FILAS']
+    total = LLMResponseCache.query.count()
+    if total > maximo:
+        viejas = [fila.key for fila in db.session.query(LLMResponseCache.key).order_by(
+            LLMResponseCache.last_used_at.asc()
+        ).limit(total - maximo * 9 // 10)]
+        LLMResponseCache.query.filter(LLMResponseCache.key.in_(viejas)).delete(synchronize_session=False)
+
+##############################################
+# Escritura diferida de mensajes             #
+##############################################
+
+class BufferMensajes:
+    """Junta los mensajes de muchas peticiones y los inserta en lotes.
+
+    Un hilo escribe cada ESCRITURA_INTERVALO_MS (o antes, si se llega a
+    ESCRITURA_LOTE_MAX filas) con un solo INSERT ... VALUES y un solo commit por
+    lote. `agregar` devuelve un Future que se resuelve cuando el lote está confirmado.
+    """
+
+    def __init__(self, lote_max, intervalo):
+        self.lote_max = lote_max
+        self.intervalo = intervalo
+        self._pendientes = []
+        self._filas = 0
+        self._condicion = threading.Condition()
+        self._hilo = None
+
+    def agregar(self, filas):
+        pendiente = Future()
+        with self._condicion:
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._bucle, daemon=True)
+                self._hilo.start()
+            self._pendientes.append((filas, pendiente))
+            self._filas += len(filas)
+            if len(self._pendientes) == 1 or self._filas >= self.lote_max:
+                self._condicion.notify()
+        return pendiente
+
+    def _tomar(self):
+        lote, self._pendientes, self._filas = self._pendientes, [], 0
+        return lote
+
+    def _bucle(self):
+        while True:
+            with self._condicion:
+                self._condicion.wait_for(lambda: self._pendientes)
+                # Se deja pasar el intervalo para que se sumen más peticiones al lote
+                self._condicion.wait_for(lambda: self._filas >= self.lote_max, timeout=self.intervalo)
+                lote = self._tomar()
+            self._escribir(lote)
+
+    def vaciar(self):
+        """Escribe lo pendiente sin esperar al hilo (al terminar el proceso)."""
+        with self._condicion:
+            lote = self._tomar()
+        if lote:
+            self._escribir(lote)
+
+    def _escribir(self, lote):
+        filas = [fila for filas, _ in lote for fila in filas]
+        try:
+            with app.app_context():
+                ids = db.session.scalars(
+                    insert(Message).returning(Message.id, sort_by_parameter_order=True), filas
+                ).all()
+                puntos = [
+                    {"user_id": fila["user_id"], "message_id": message_id, "content": punto, "timestamp": fila["timestamp"]}
+                    for fila, message_id in zip(filas, ids) if fila["role"] == 'assistant'
+                    for punto in extraer_puntos_clave(fila["content"])
+                ]
+                if puntos:
+                    db.session.execute(insert(KeyPoint), puntos)
+                db.session.commit()
+        except Exception as e:
+            app.logger.error(f"Error al escribir un lote de {len(filas)} mensajes: {e}")
+            for _, pendiente in lote:
+                pendiente.set_exception(e)
+        else:
+            for _, pendiente in lote:
+                pendiente.set_result(len(filas))
+
+_buffer_mensajes = BufferMensajes(app.config['ESCRITURA_LOTE_MAX'], app.config['ESCRITURA_INTERVALO_MS'] / 1000)
+atexit.register(_buffer_mensajes.vaciar)
+
+##############################################
+# Caché de usuarios                          #
+##############################################
+
+# Lo que las rutas leen de current_user en cada petición
+CAMPOS_USUARIO_CACHE = ('id', 'username', 'memory_mode', 'prompt_template')
+# Los que el propio alumno puede cambiar: su último valor viaja en la cookie de sesión,
+# así otro worker con una copia vieja en su caché de proceso la descarta
+CAMPOS_USUARIO_MUTABLES = ('id', 'memory_mode')
+
+_cache_usuarios = CacheLRU(app.config['USUARIOS_CACHE_MAX'], app.config['USUARIOS_CACHE_TTL'])
+METRICA_CACHE_USUARIOS = Counter(
+    'profai_cache_usuarios_total', 'Usuarios resueltos por load_user según su origen', ['origen']
+)
+
+def usuario_en_cache(user_id):
+    """Campos del usuario desde la cookie de sesión o la caché del proceso, o None."""
+    if app.config['USUARIO_EN_SESION']:
+        guardado = session.get('_usuario')
+        if guardado and guardado['id'] == user_id and guardado['vence'] > time.time():
+            METRICA_CACHE_USUARIOS.labels('sesion').inc()
+            return guardado
+    campos = _cache_usuarios.get(user_id)
+    METRICA_CACHE_USUARIOS.labels('memoria' if campos else 'base_de_datos').inc()
+    return campos
+
+def coincide_con_sesion(campos):
+    """False si la sesión del alumno vio un valor más nuevo de sus campos mutables."""
+    marcados = session.get('_usuario_marcas') if has_request_context() else None
+    if not marcados or marcados['id'] != campos['id']:
+        return True
+    return all(campos[campo] == valor for campo, valor in marcados.items())
+
+def marcar_usuario_en_sesion(user):
+    """Llamar tras cambiar un campo de CAMPOS_USUARIO_MUTABLES en la petición del alumno."""
+    session['_usuario_marcas'] = {campo: getattr(user, campo) for campo in CAMPOS_USUARIO_MUTABLES}
+
+def recordar_usuario(user):
+    campos = {campo: getattr(user, campo) for campo in CAMPOS_USUARIO_CACHE}
+    _cache_usuarios.set(user.id, campos)
+    if app.config['USUARIO_EN_SESION'] and has_request_context():
+        # La cookie va firmada, no cifrada: solo lleva datos que el alumno ya conoce
+        session['_usuario'] = {**campos, 'vence': time.time() + app.config['USUARIO_EN_SESION_TTL']}
+
+def olvidar_usuario(user_id):
+    _cache_usuarios.pop(user_id)
+    if has_request_context() and session.get('_usuario', {}).get('id') == user_id:
+        session.pop('_usuario')
+    if has_request_context() and session.get('_usuario_marcas', {}).get('id') == user_id:
+        session.pop('_usuario_marcas')
+
+##############################################
+# Comandos del chat                          #
+##############################################
+
 def procesar_comando(comando, contenido):
     prompts = {
         '/explicar': (
@@ -151,6 +1501,187 @@ def procesar_comando(comando, contenido):
     }
     return prompts.get(comando, None)
 
+##############################################
+# Contraseñas y límites de acceso            #
+##############################################
+
+class ColaHashLlena(Exception):
+    """Hay demasiados hashes de contraseña en espera en este worker."""
+
+_pool_hash = None
+_pool_hash_lock = threading.Lock()
+_hashes_en_curso = 0
+
+def _en_pool_hash(funcion, *args):
+    """Corre un hash (scrypt/pbkdf2, CPU puro) fuera del worker, sin encolar sin límite.
+
+    Una ráfaga de logins al empezar la clase no debe dejar sin CPU a /chat: pasado
+    HASH_COLA_MAX se rechaza en lugar de esperar.
+    """
+    global _pool_hash, _hashes_en_curso
+    with _pool_hash_lock:
+        if _hashes_en_curso >= app.config['HASH_COLA_MAX']:
+            raise ColaHashLlena()
+        _hashes_en_curso += 1
+        if _pool_hash is None:
+            _pool_hash = ProcessPoolExecutor(max_workers=app.config['HASH_PROCESOS'])
+    try:
+        with medir('hash'):
+            return _pool_hash.submit(funcion, *args).result()
+    finally:
+        with _pool_hash_lock:
+            _hashes_en_curso -= 1
+
+def hashear_password(password):
+    return _en_pool_hash(generate_password_hash, password, app.config['HASH_METODO'])
+
+@lru_cache(maxsize=1)
+def _prefijo_hash_actual():
+    """Método y parámetros tal como los guarda werkzeug (p. ej. 'scrypt' -> 'scrypt:32768:8:1')."""
+    return generate_password_hash('', app.config['HASH_METODO']).split('$', 1)[0]
+
+def verificar_password(user, password):
+    """Comprueba la contraseña y, si el hash usa parámetros viejos, lo regenera."""
+    guardado = user.password
+    liberar_conexion()  # El hash puede esperar en la cola del pool
+    if not _en_pool_hash(check_password_hash, guardado, password):
+        return False
+    if guardado.split('$', 1)[0] != _prefijo_hash_actual():
+        try:
+            user.password = hashear_password(password)
+        except ColaHashLlena:
+            # La contraseña ya es correcta: el rehash queda para un login más tranquilo
+            return True
+        db.session.commit()
+    return True
+
+class LimitadorTokens:
+    """Cubetas de tokens en un SQLite local, compartidas por los procesos del servidor.
+
+    Cada clave arranca con `rafaga` tokens y recupera `por_minuto` por minuto; cada
+    intento consume uno. `consumir` devuelve 0 si se permite o los segundos a esperar.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._preparado = False
+
+    def _conectar(self):
+        if not self._preparado:
+            os.makedirs(os.path.dirname(self.ruta) or '.', exist_ok=True)
+        conexion = sqlite3.connect(self.ruta, timeout=5, isolation_level=None)
+        if not self._preparado:
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute(
+                "CREATE TABLE IF NOT EXISTS cubeta (clave TEXT PRIMARY KEY, tokens REAL NOT NULL, actualizado REAL NOT NULL)"
+            )
+            self._preparado = True
+        return conexion
+
+    def consumir(self, clave, rafaga, por_minuto, gastar=True):
+        """Con gastar=False solo consulta si quedaría un token, sin descontarlo."""
+        ahora = time.time()
+        conexion = self._conectar()
+        try:
+            conexion.execute("BEGIN IMMEDIATE")
+            fila = conexion.execute("SELECT tokens, actualizado FROM cubeta WHERE clave = ?", (clave,)).fetchone()
+            tokens = rafaga if fila is None else min(rafaga, fila[0] + (ahora - fila[1]) * por_minuto / 60)
+            espera = 0 if tokens >= 1 else (1 - tokens) * 60 / por_minuto
+            if not espera and gastar:
+                tokens -= 1
+            conexion.execute("INSERT OR REPLACE INTO cubeta VALUES (?, ?, ?)", (clave, tokens, ahora))
+            # De paso se olvidan las cubetas que ya se habrían llenado del todo
+            conexion.execute("DELETE FROM cubeta WHERE actualizado < ?", (ahora - 86400,))
+            conexion.execute("COMMIT")
+            return espera
+        finally:
+            conexion.close()
+
+_limitador = LimitadorTokens(app.config['LIMITES_DB']) if app.config['LIMITES_DB'] else None
+
+def intentos_agotados(username=None, gastar=True):
+    """Segundos que debe esperar el cliente antes de reintentar, o 0.
+
+    Con gastar=False no descuenta el intento (el login lo descuenta solo si falla,
+    con `registrar_fallo`).
+    """
+    if _limitador is None:
+        return 0
+    try:
+        espera = _limitador.consumir(
+            f"ip:{request.remote_addr}", app.config['LOGIN_RAFAGA_IP'], app.config['LOGIN_POR_MINUTO_IP'], gastar
+        )
+        if username and not espera:
+            espera = _limitador.consumir(
+                f"usuario:{username.casefold()}", app.config['LOGIN_RAFAGA_USUARIO'],
+                app.config['LOGIN_POR_MINUTO_USUARIO'], gastar
+            )
+        return espera
+    except sqlite3.Error as e:
+        # Sin el almacén de límites se sigue atendiendo, como antes
+        app.logger.warning(f"Limitador de intentos no disponible: {e}")
+        return 0
+
+def registrar_fallo(username):
+    intentos_agotados(username)
+
+def _rechazar(plantilla, estado, mensaje, espera):
+    flash(mensaje, "danger")
+    response = make_response(render_template(plantilla), estado)
+    response.headers["Retry-After"] = str(max(1, int(espera + 0.999)))
+    return response
+
+##############################################
+# Recursos estáticos                         #
+##############################################
+
+# Bibliotecas de terceros: nombre -> (paquete de npm, versión, rutas del paquete que
+# se usan). `flask descargar-recursos` las deja en static/vendor/<nombre>-<versión>/;
+# gunicorn.conf.py lo ejecuta al arrancar si faltan. Si aun así no están (desarrollo,
+# registro inaccesible), las plantillas usan el CDN y se avisa en el log.
+# MathJax carga bajo demanda, relativas a su propio script, las extensiones de TeX que
+# no trae el combinado (\boldsymbol, \cancel, \color, \ce, physics...).
+BIBLIOTECAS = {
+    'mathjax': ('mathjax', '3.2.2', (
+        'es5/tex-mml-chtml.js', 'es5/input/tex/extensions/', 'es5/output/chtml/fonts/woff-v2/'
+    )),
+    'fontawesome': ('@fortawesome/fontawesome-free', '6.0.0', ('css/all.min.css', 'webfonts/')),
+}
+REGISTRO_NPM = os.environ.get("REGISTRO_NPM", "https://registry.npmjs.org")
+# Las URLs con huella (?v=...) y las de vendor/ (versión en la ruta) no cambian nunca de contenido
+CACHE_ESTATICOS = "public, max-age=31536000, immutable"
+
+@lru_cache(maxsize=256)
+def _huella(ruta, modificado):
+    with open(ruta, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+def url_estatica(archivo):
+    """URL de un archivo de static/ con la huella de su contenido, para cachearlo sin caducidad."""
+    ruta = os.path.join(app.static_folder, archivo)
+    return url_for('static', filename=archivo, v=_huella(ruta, os.path.getmtime(ruta)))
+
+_avisos_cdn = set()
+
+def url_biblioteca(nombre, archivo):
+    paquete, version, _ = BIBLIOTECAS[nombre]
+    local = f"vendor/{nombre}-{version}/{archivo}"
+    if os.path.exists(os.path.join(app.static_folder, local)):
+        return url_for('static', filename=local)
+    if nombre not in _avisos_cdn:
+        _avisos_cdn.add(nombre)
+        app.logger.warning(f"{nombre} {version} no está en static/vendor; se sirve desde el CDN (ejecuta `flask descargar-recursos`)")
+    return f"https://cdn.jsdelivr.net/npm/{paquete}@{version}/{archivo}"
+
+app.jinja_env.globals.update(url_estatica=url_estatica, url_biblioteca=url_biblioteca)
+
+@app.after_request
+def cachear_estaticos(response):
+    if request.endpoint == 'static' and response.status_code == 200:
+        if 'v' in request.args or request.view_args['filename'].startswith('vendor/'):
+            response.headers['Cache-Control'] = CACHE_ESTATICOS
+    return response
+
 ##############################################
 # Rutas de Autenticación                     #
 ##############################################
@@ -160,6 +1691,10 @@ def register():
     if request.method == 'POST':
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '').strip()
+
+        espera = intentos_agotados()
+        if espera:
+            return _rechazar('register.html', 429, "Demasiados intentos. Espera un momento.", espera)
         
         if len(password) < 8:
             flash("La contraseña debe tener al menos 8 caracteres", "danger")
@@ -169,22 +1704,21 @@ def register():
             flash("El usuario ya existe", "danger")
             return redirect(url_for('register'))
             
+        liberar_conexion()  # El hash puede esperar en la cola del pool
+        try:
+            password_hash = hashear_password(password)
+        except ColaHashLlena:
+            return _rechazar('register.html', 503, "Servidor ocupado. Intenta en unos segundos.", 5)
+
         new_user = User(
             username=username,
-            password=generate_password_hash(password),
+            password=password_hash,
             memory_mode=False
         )
         db.session.add(new_user)
         db.session.commit()
-        
-        # Crear mensaje de sistema para el nuevo usuario
-        system_msg = Message(
-            user_id=new_user.id,
-            role='system',
-            content=system_prompt_content
-        )
-        db.session.add(system_msg)
-        db.session.commit()
+        # Un id reutilizado (SQLite sin AUTOINCREMENT) no debe heredar datos en caché
+        olvidar_usuario(new_user.id)
         
         flash("Registro exitoso. Inicia sesión.", "success")
         return redirect(url_for('login'))
@@ -195,13 +1729,23 @@ def login():
     if request.method == 'POST':
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '').strip()
+
+        espera = intentos_agotados(username, gastar=False)
+        if espera:
+            return _rechazar('login.html', 429, "Demasiados intentos. Espera un momento.", espera)
+
         user = User.query.filter_by(username=username).first()
+        try:
+            valido = user is not None and verificar_password(user, password)
+        except ColaHashLlena:
+            return _rechazar('login.html', 503, "Servidor ocupado. Intenta en unos segundos.", 5)
         
-        if user and check_password_hash(user.password, password):
+        if valido:
             login_user(user)
             flash("Inicio de sesión exitoso", "success")
             return redirect(url_for('index'))
         else:
+            registrar_fallo(username)
             flash("Credenciales inválidas", "danger")
             return redirect(url_for('login'))
     return render_template('login.html')
@@ -209,6 +1753,7 @@ def login():
 @app.route('/logout')
 @login_required
 def logout():
+    olvidar_usuario(current_user.id)
     logout_user()
     flash("Sesión cerrada", "info")
     return redirect(url_for('login'))
@@ -231,89 +1776,360 @@ def chat():
 
     if user_message.startswith('/clear'):
         try:
-            Message.query.filter(
-                Message.user_id == current_user.id,
-                Message.role != 'system'
-            ).delete()
-            db.session.commit()
+            borrar_historial(current_user.id)
             return jsonify({"response": "🔄 Historial borrado correctamente"})
         except Exception as e:
             app.logger.error(f"Error al borrar historial: {str(e)}")
             return jsonify({"response": "⚠️ Error al borrar el historial"}), 500
 
-    user_msg = Message(
-        user_id=current_user.id,
-        role='user',
-        content=user_message
-    )
-    db.session.add(user_msg)
-    db.session.commit()
+    # La pregunta se guarda junto con la respuesta, en un solo commit al final del turno
+    recibido = datetime.utcnow()
+    user_id = current_user.id
+    memory_mode = current_user.memory_mode  # El commit del turno expira current_user
+
+    # Un doble envío del mismo mensaje no genera otra llamada ni otro turno
+    turno, primero = unirse_a_turno(user_id, user_message)
+    if not primero:
+        return respuesta_compartida(turno, request.json.get('stream'))
 
     try:
-        mensajes_db = Message.query.filter_by(user_id=current_user.id).order_by(Message.timestamp.asc()).all()
-        
-        if current_user.memory_mode:
-            mensajes = [{"role": msg.role, "content": msg.content} for msg in mensajes_db]
-        else:
-            system_msg = next((msg for msg in mensajes_db if msg.role == 'system'), None)
-            last_msg = mensajes_db[-1] if mensajes_db else None
-            mensajes = []
-            if system_msg:
-                mensajes.append({"role": system_msg.role, "content": system_msg.content})
-            if last_msg:
-                mensajes.append({"role": last_msg.role, "content": last_msg.content})
-
-        if user_message.startswith('/'):
-            comando = user_message.split()[0].lower()
-            contenido = user_message[len(comando):].strip()
-            prompt_comando = procesar_comando(comando, contenido)
-            if prompt_comando:
-                mensajes.append({"role": "user", "content": prompt_comando})
-
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=mensajes,
-            max_tokens=15000,
-            temperature=0.7
-        )
-        bot_response = sanitizar_markdown(response.choices[0].message.content)
-        
-        assistant_msg = Message(
-            user_id=current_user.id,
-            role='assistant',
-            content=bot_response
-        )
-        db.session.add(assistant_msg)
-        db.session.commit()
-        
-        return jsonify({"response": bot_response})
+        if request.json.get('stream'):
+            return chat_stream(user_message, recibido, turno)
+
+        with medir('contexto'):
+            mensajes = construir_mensajes(user_message)
+
+        clave_cache = clave_cache_llm(user_message, mensajes)
+        en_cache = cache_llm_obtener(clave_cache) if clave_cache else None
+        bot_response = en_cache
+        if en_cache is None:
+            liberar_conexion()
+            with medir('openai'):
+                response = completar_chat(mensajes, user_id=user_id)
+            bot_response = response.choices[0].message.content
+
+        with medir('commit'), unidad_de_trabajo():
+            if clave_cache and en_cache is None:
+                cache_llm_guardar(clave_cache, bot_response)
+            guardar_turno(user_id, user_message, bot_response, recibido)
+
+        terminar_turno(turno, bot_response)
+        if memory_mode:
+            programar_resumen(user_id)
+
+        # Se guarda el texto crudo del modelo; solo lo que va al navegador se sanitiza
+        with medir('sanitizar'):
+            salida = sanitizar_markdown(bot_response)
+        return jsonify({"response": salida})
     
     except Exception as e:
+        terminar_turno(turno, error=e)
         db.session.rollback()
         app.logger.error(f"Error en OpenAI: {str(e)}")
+        guardar_pregunta_sin_respuesta(user_id, user_message, recibido)
         return jsonify({"response": "⚠️ Error al procesar tu solicitud. Intenta nuevamente."}), 500
 
-@app.route('/export', methods=['GET'])
-@login_required
-def export_chat():
+def guardar_pregunta_sin_respuesta(user_id, user_message, recibido):
+    """Tras un error la pregunta igual queda en el historial del alumno."""
     try:
-        messages = Message.query.filter(
-            Message.user_id == current_user.id,
+        guardar_turno(user_id, user_message, None, recibido)
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Error al guardar el mensaje del usuario: {str(e)}")
+
+def construir_mensajes(user_message):
+    """Arma la lista de mensajes que se envía al modelo para el turno actual."""
+    prompt_sistema = obtener_prompt_sistema(current_user.prompt_template)
+    if current_user.memory_mode:
+        with leer_de_replica():
+            mensajes = construir_contexto(current_user.id, prompt_sistema, turno_actual=user_message)
+    else:
+        # Sin memoria solo viaja el mensaje actual, que todavía no está en la base
+        mensajes = [
+            {"role": "system", "content": prompt_sistema},
+            {"role": "user", "content": user_message}
+        ]
+
+    # De los archivos subidos solo viajan los fragmentos relevantes para este mensaje
+    fragmentos = buscar_fragmentos(current_user.id, user_message)
+    if fragmentos:
+        mensajes.insert(1, {"role": "system", "content": "Fragmentos relevantes de los archivos del alumno:\n\n" + "\n\n".join(
+            f"[{filename}, parte {fragmento.position + 1}]\n{fragmento.content}" for filename, fragmento in fragmentos
+        )})
+
+    if user_message.startswith('/'):
+        comando = user_message.split()[0].lower()
+        contenido = user_message[len(comando):].strip()
+        prompt_comando = procesar_comando(comando, contenido)
+        if prompt_comando:
+            mensajes.append({"role": "user", "content": prompt_comando})
+    return mensajes
+
+def _evento_sse(datos, evento=None):
+    linea = f"data: {json.dumps(datos, ensure_ascii=False)}\n\n"
+    return f"event: {evento}\n{linea}" if evento else linea
+
+def chat_stream(user_message, recibido, turno):
+    """Variante de /chat que reenvía los deltas del modelo como Server-Sent Events."""
+    def deltas(stream):
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    # El historial y el usuario se resuelven antes de empezar a emitir: el generador
+    # corre fuera del ciclo normal de la petición y no debe tocar `current_user`.
+    user_id = current_user.id
+    memory_mode = current_user.memory_mode
+    with medir('contexto'):
+        mensajes = construir_mensajes(user_message)
+    clave_cache = clave_cache_llm(user_message, mensajes)
+    en_cache = cache_llm_obtener(clave_cache) if clave_cache else None
+    # El generador corre mientras dura toda la respuesta del modelo
+    liberar_conexion()
+
+    def generar():
+        partes = []
+        inicio = time.perf_counter()
+        try:
+            if en_cache is not None:
+                fragmentos = [en_cache]
+            else:
+                fragmentos = deltas(completar_chat(mensajes, stream=True, user_id=user_id))
+            def crudos():
+                # `partes` acumula el texto crudo que se guarda; al navegador solo llega lo sanitizado
+                for fragmento in fragmentos:
+                    if not partes:
+                        g.etapas['primer_token'] = round((time.perf_counter() - inicio) * 1000, 2)
+                    partes.append(fragmento)
+                    yield fragmento
+
+            with medir('openai'):
+                for seguro in sanitizar_stream(crudos()):
+                    yield _evento_sse({"delta": seguro})
+            # El turno completo se persiste una sola vez, al terminar el stream
+            with medir('commit'), unidad_de_trabajo():
+                if clave_cache and en_cache is None:
+                    cache_llm_guardar(clave_cache, "".join(partes))
+                guardar_turno(user_id, user_message, "".join(partes), recibido)
+            terminar_turno(turno, "".join(partes))
+            if memory_mode:
+                programar_resumen(user_id)
+            yield _evento_sse({"done": True}, evento='done')
+            registrar_linea('stream', duracion_ms=round((time.perf_counter() - inicio) * 1000, 2))
+        except Exception as e:
+            terminar_turno(turno, error=e)
+            db.session.rollback()
+            app.logger.error(f"Error en OpenAI (stream): {str(e)}")
+            guardar_pregunta_sin_respuesta(user_id, user_message, recibido)
+            yield _evento_sse({"response": "⚠️ Error al procesar tu solicitud. Intenta nuevamente."}, evento='error')
+        finally:
+            # Si el alumno cierra la conexión a mitad del stream, los duplicados no quedan esperando
+            terminar_turno(turno, error=RuntimeError("Stream interrumpido"))
+
+    response = Response(stream_with_context(generar()), mimetype='text/event-stream')
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+def _mensajes_exportables(user_id, lote=500):
+    """Recorre el historial exportable por páginas (keyset sobre timestamp, id).
+
+    Cada página es una consulta corta de tuplas, sin cursores abiertos durante
+    la descarga ni objetos acumulados en la sesión. Los mensajes ya archivados
+    salen primero.
+    """
+    yield from (msg for msg in mensajes_archivados(user_id) if msg.role != 'system')
+    ultimo = None
+    while True:
+        consulta = db.session.query(Message.id, Message.role, Message.content, Message.timestamp).filter(
+            Message.user_id == user_id,
             Message.role != 'system'
-        ).order_by(Message.timestamp.asc()).all()
-        
-        chat_content = "\n".join(
-            f"{msg.role.capitalize()} ({msg.timestamp}): {msg.content}" 
-            for msg in messages
         )
-        
-        response = make_response(chat_content)
-        response.headers["Content-Disposition"] = f"attachment; filename=chat_export_{datetime.now().strftime('%Y%m%d%H%M')}.txt"
-        response.headers["Content-type"] = "text/plain"
-        return response
-    except Exception as e:
-        app.logger.error(f"Error en exportación: {str(e)}")
-        return jsonify({"response": "⚠️ Error al exportar el chat"}), 500
+        if ultimo:
+            consulta = consulta.filter(db.or_(
+                Message.timestamp > ultimo.timestamp,
+                db.and_(Message.timestamp == ultimo.timestamp, Message.id > ultimo.id)
+            ))
+        with leer_de_replica():
+            filas = consulta.order_by(Message.timestamp.asc(), Message.id.asc()).limit(lote).all()
+        yield from filas
+        if len(filas) < lote:
+            return
+        ultimo = filas[-1]
+
+def _exportar_txt(filas):
+    for i, msg in enumerate(filas):
+        yield f"{chr(10) if i else ''}{msg.role.capitalize()} ({msg.timestamp}): {msg.content}"
+
+def _exportar_md(filas):
+    yield "# Exportación del chat\n\n"
+    for msg in filas:
+        yield f"### {msg.role.capitalize()} ({msg.timestamp})\n\n{msg.content}\n\n"
+
+def _exportar_jsonl(filas):
+    for msg in filas:
+        yield json.dumps({
+            "role": msg.role,
+            "content": msg.content,
+            "timestamp": msg.timestamp.isoformat() if msg.timestamp else None
+        }, ensure_ascii=False) + "\n"
+
+def _exportar_pdf(filas):
+    """PDF de texto plano escrito objeto por objeto, sin armar el documento en memoria.
+
+    fpdf construye todo el archivo antes de devolverlo; aquí cada página se emite
+    apenas se llena y solo se guardan los offsets para la tabla xref final.
+    """
+    lineas_por_pagina, ancho = 60, 95
+    offsets, kids = [], []
+    escrito = 0
+
+    def objeto(numero, cuerpo):
+        nonlocal escrito
+        while len(offsets) < numero:
+            offsets.append(None)
+        offsets[numero - 1] = escrito
+        datos = f"{numero} 0 obj\n".encode('latin-1') + cuerpo + b"\nendobj\n"
+        escrito += len(datos)
+        return datos
+
+    def pagina(lineas):
+        numero = len(offsets) + 1
+        texto = "".join(
+            "(" + linea.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ") Tj T*\n"
+            for linea in lineas
+        ).encode('cp1252', errors='replace')
+        contenido = b"BT /F1 10 Tf 12 TL 40 800 Td\n" + texto + b"ET"
+        kids.append(numero + 1)
+        return objeto(numero, b"<< /Length %d >>\nstream\n" % len(contenido) + contenido + b"\nendstream") + objeto(
+            numero + 1,
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % numero
+        )
+
+    cabecera = b"%PDF-1.4\n"
+    escrito = len(cabecera)
+    yield cabecera
+    yield objeto(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+    offsets.append(None)  # El objeto 2 (árbol de páginas) se escribe al final
+    yield objeto(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+
+    pendientes = []
+    for msg in filas:
+        encabezado = f"{msg.role.capitalize()} ({msg.timestamp}):"
+        for linea in [encabezado] + msg.content.splitlines() + [""]:
+            pendientes.extend(textwrap.wrap(linea, ancho) or [""])
+            while len(pendientes) >= lineas_por_pagina:
+                yield pagina(pendientes[:lineas_por_pagina])
+                pendientes = pendientes[lineas_por_pagina:]
+    if pendientes or not kids:
+        yield pagina(pendientes)
+
+    yield objeto(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % kid for kid in kids), len(kids)
+    ))
+    inicio_xref = escrito
+    yield (
+        f"xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n".encode('latin-1')
+        + b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+        + f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{inicio_xref}\n%%EOF\n".encode('latin-1')
+    )
+
+FORMATOS_EXPORTACION = {
+    'txt': (_exportar_txt, 'text/plain; charset=utf-8'),
+    'md': (_exportar_md, 'text/markdown; charset=utf-8'),
+    'jsonl': (_exportar_jsonl, 'application/x-ndjson'),
+    'pdf': (_exportar_pdf, 'application/pdf'),
+}
+
+@app.route('/export', methods=['GET'])
+@login_required
+def export_chat():
+    formato = request.args.get('formato', 'txt').lower()
+    if formato not in FORMATOS_EXPORTACION:
+        return jsonify({"response": "⚠️ Formato de exportación no soportado"}), 400
+
+    exportador, mimetype = FORMATOS_EXPORTACION[formato]
+    user_id = current_user.id
+    # Con la descarga en curso ya no se puede avisar: el archivo ilegible se detecta antes
+    if zstandard is None and MessageArchive.query.filter_by(user_id=user_id, codec='zstd').first():
+        app.logger.error("Exportación imposible: hay mensajes archivados con zstd y zstandard no está instalado")
+        return jsonify({"response": "⚠️ No se pudo leer el historial archivado"}), 500
+
+    def generar():
+        try:
+            yield from exportador(_mensajes_exportables(user_id))
+        except Exception as e:
+            # Con la respuesta ya en curso no se puede cambiar el código de estado
+            app.logger.error(f"Error en exportación: {str(e)}")
+
+    response = Response(stream_with_context(generar()), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename=chat_export_{datetime.now().strftime('%Y%m%d%H%M')}.{formato}"
+    return response
+
+@app.route('/history', methods=['GET'])
+@login_required
+def history():
+    """Una página del historial anterior al mensaje `before`, del más antiguo al más nuevo.
+
+    Keyset sobre (timestamp, id), el mismo orden que usa chat(): cada página es una
+    lectura acotada del índice (user_id, timestamp) sin importar cuán atrás esté.
+    `next_before` es el cursor de la página siguiente, o null si no quedan mensajes.
+    """
+    limite = request.args.get('limit', app.config['HISTORIAL_PAGINA'], type=int)
+    antes = request.args.get('before', type=int)
+    if limite < 1:
+        return jsonify({"response": "⚠️ El parámetro limit debe ser positivo"}), 400
+    limite = min(limite, app.config['HISTORIAL_PAGINA_MAX'])
+
+    consulta = db.session.query(Message.id, Message.role, Message.content, Message.timestamp).filter(
+        Message.user_id == current_user.id,
+        Message.role != 'system'
+    )
+    if antes is not None:
+        ancla = db.session.query(Message.timestamp).filter(
+            Message.id == antes,
+            Message.user_id == current_user.id
+        ).scalar_subquery()
+        consulta = consulta.filter(db.or_(
+            Message.timestamp < ancla,
+            db.and_(Message.timestamp == ancla, Message.id < antes)
+        ))
+    with leer_de_replica():
+        filas = consulta.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limite + 1).all()
+
+    hay_mas = len(filas) > limite
+    filas = filas[:limite][::-1]
+    return jsonify({
+        "messages": [{
+            "id": fila.id,
+            "role": fila.role,
+            # Se guarda el texto crudo del modelo; las filas ya sanitizadas por versiones
+            # anteriores no cambian (es idempotente)
+            "content": sanitizar_markdown(fila.content),
+            "timestamp": fila.timestamp.isoformat()
+        } for fila in filas],
+        "next_before": filas[0].id if hay_mas else None
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Métricas en formato Prometheus, solo con `Authorization: Bearer <METRICS_TOKEN>`.
+
+    Expone latencias por ruta y actividad de los alumnos: sin token configurado
+    responde 404 en lugar de quedar público.
+    """
+    token = app.config['METRICS_TOKEN']
+    if not token:
+        return jsonify({"error": "No encontrado"}), 404
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return jsonify({"error": "No autorizado"}), 401
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
 
 @app.route('/toggle_memoria', methods=['POST'])
 @login_required
@@ -321,6 +2137,10 @@ def toggle_memoria():
     try:
         current_user.memory_mode = not current_user.memory_mode
         db.session.commit()
+        # Releído de la primaria tras el commit: las cachés quedan con el valor nuevo, y
+        # la marca en la sesión invalida la copia que tengan los demás workers
+        recordar_usuario(current_user)
+        marcar_usuario_en_sesion(current_user)
         return jsonify({
             "status": "success",
             "memory_mode": current_user.memory_mode,
@@ -334,21 +2154,40 @@ def toggle_memoria():
 @app.route('/resumen', methods=['GET'])
 @login_required
 def resumen():
+    """Puntos clave del alumno en orden cronológico, paginados con ?limit= y ?despues=<id>."""
+    limite = request.args.get('limit', app.config['PUNTOS_CLAVE_PAGINA'], type=int)
+    if limite < 1:
+        return jsonify({"response": "⚠️ El parámetro limit debe ser positivo"}), 400
+    limite = min(limite, app.config['PUNTOS_CLAVE_PAGINA_MAX'])
     try:
-        puntos_clave = Message.query.filter(
-            Message.user_id == current_user.id,
-            Message.role == 'assistant',
-            Message.content.like('%### Punto clave%')
-        ).order_by(Message.timestamp.asc()).all()
+        with leer_de_replica():
+            consulta = KeyPoint.query.filter(KeyPoint.user_id == current_user.id)
+
+            if 'despues' in request.args:
+                # Un cursor desconocido o ajeno no reinicia desde la primera página: el
+                # cliente repetiría puntos o no terminaría nunca de paginar
+                despues = request.args.get('despues', type=int)
+                cursor = despues and KeyPoint.query.filter_by(id=despues, user_id=current_user.id).first()
+                if not cursor:
+                    return jsonify({"response": "⚠️ El parámetro despues no corresponde a ningún punto clave"}), 400
+                consulta = consulta.filter(db.or_(
+                    KeyPoint.timestamp > cursor.timestamp,
+                    db.and_(KeyPoint.timestamp == cursor.timestamp, KeyPoint.id > cursor.id)
+                ))
+
+            puntos_clave = consulta.order_by(KeyPoint.timestamp.asc(), KeyPoint.id.asc()).limit(limite + 1).all()
+            siguiente = puntos_clave[limite - 1].id if len(puntos_clave) > limite else None
+            puntos_clave = puntos_clave[:limite]
         
         if not puntos_clave:
             return jsonify({"response": "ℹ️ Aún no hay suficiente información para generar un resumen."})
         
         resumen_text = "## Resumen de aprendizaje\n" + "\n\n".join(
-            f"### {msg.timestamp}\n{msg.content}" 
-            for msg in puntos_clave
+            f"### {punto.timestamp}\n{punto.content}" 
+            for punto in puntos_clave
         )
-        return jsonify({"response": resumen_text})
+        # Los puntos clave salen del texto crudo del modelo
+        return jsonify({"response": sanitizar_markdown(resumen_text), "siguiente": siguiente})
     except Exception as e:
         app.logger.error(f"Error en resumen: {str(e)}")
         return jsonify({"response": "⚠️ Error al generar el resumen"}), 500
@@ -357,6 +2196,161 @@ def resumen():
 # Ruta para subir archivos (incluyendo PDF y DOCX)
 ##############################################
 
+# La extracción corre en procesos aparte (PyPDF2 es CPU puro y bloquearía el worker);
+# un hilo coordinador por subida reparte las páginas y va registrando el progreso.
+_coordinador_subidas = ThreadPoolExecutor(max_workers=4, thread_name_prefix='subidas')
+_pool_extraccion = None
+_pool_extraccion_lock = threading.Lock()
+
+def _obtener_pool_extraccion():
+    global _pool_extraccion
+    with _pool_extraccion_lock:
+        if _pool_extraccion is None:
+            _pool_extraccion = ProcessPoolExecutor(max_workers=app.config['UPLOAD_PROCESOS'])
+        return _pool_extraccion
+
+def _contar_paginas_pdf(ruta):
+    return len(PyPDF2.PdfReader(ruta).pages)
+
+def _extraer_paginas_pdf(ruta, desde, hasta):
+    """Texto de las páginas [desde, hasta) de un PDF; se ejecuta en el pool de procesos."""
+    paginas = PyPDF2.PdfReader(ruta).pages
+    partes = []
+    for indice in range(desde, hasta):
+        page_text = paginas[indice].extract_text()
+        if page_text:
+            partes.append(page_text)
+    return partes
+
+def _extraer_docx(ruta):
+    return "\n".join(para.text for para in Document(ruta).paragraphs)
+
+def _actualizar_trabajo(job, **campos):
+    for campo, valor in campos.items():
+        setattr(job, campo, valor)
+    db.session.commit()
+
+def _borrar_spool(job_id):
+    try:
+        os.remove(os.path.join(app.config['UPLOAD_SPOOL_DIR'], job_id))
+    except FileNotFoundError:
+        pass
+
+def descartar_subidas_huerfanas(job_id=None):
+    """Marca como error los trabajos sin progreso reciente y borra sus archivos del spool.
+
+    La cola de subidas vive en memoria: si el worker que tenía un trabajo se reinicia,
+    nadie lo retoma. Se llama al arrancar cada worker y al consultar el estado de un
+    trabajo (`job_id`), así el navegador no espera para siempre.
+    """
+    limite = datetime.utcnow() - timedelta(minutes=app.config['UPLOAD_TRABAJO_MAX_MIN'])
+    consulta = UploadJob.query.filter(
+        UploadJob.status.in_(['pendiente', 'procesando']),
+        UploadJob.updated_at < limite
+    )
+    if job_id is not None:
+        consulta = consulta.filter(UploadJob.id == job_id)
+    huerfanos = consulta.all()
+    for job in huerfanos:
+        app.logger.warning(f"Subida {job.id} ({job.filename}) sin progreso desde {job.updated_at}; se descarta")
+        job.status = 'error'
+        job.error = "El procesamiento se interrumpió. Vuelve a subir el archivo."
+        _borrar_spool(job.id)
+    if huerfanos:
+        db.session.commit()
+
+def extraer_texto(job, ruta, extension):
+    """Extrae el texto de un archivo en el spool y registra cuánto tardó."""
+    inicio = time.perf_counter()
+    try:
+        return _extraer_texto(job, ruta, extension)
+    finally:
+        duracion = time.perf_counter() - inicio
+        METRICA_EXTRACCION.labels(extension).observe(duracion)
+        registrar_linea('extraccion', tipo=extension, archivo=job.filename,
+                        paginas=job.pages_total, duracion_ms=round(duracion * 1000, 2))
+
+def _extraer_texto(job, ruta, extension):
+    """Extrae el texto de un archivo en el spool, actualizando el progreso de `job`."""
+    pool = _obtener_pool_extraccion()
+    if extension == 'pdf':
+        total = pool.submit(_contar_paginas_pdf, ruta).result()
+        _actualizar_trabajo(job, pages_total=total)
+        paso = app.config['UPLOAD_PAGINAS_POR_TAREA']
+        tramos = [(desde, min(desde + paso, total)) for desde in range(0, total, paso)]
+        tareas = {pool.submit(_extraer_paginas_pdf, ruta, desde, hasta): (desde, hasta) for desde, hasta in tramos}
+        por_tramo = {}
+        for tarea in as_completed(tareas):
+            desde, hasta = tareas[tarea]
+            por_tramo[desde] = tarea.result()
+            _actualizar_trabajo(job, pages_done=job.pages_done + hasta - desde)
+        text = "\n".join(pagina for desde in sorted(por_tramo) for pagina in por_tramo[desde])
+        return text if text.strip() != "" else "No se pudo extraer texto del PDF."
+    elif extension == 'docx':
+        text = pool.submit(_extraer_docx, ruta).result()
+        return text if text.strip() != "" else "No se pudo extraer texto del archivo DOCX."
+    else:
+        with open(ruta, encoding='utf-8') as archivo:
+            return archivo.read()
+
+def _sha256_archivo(ruta):
+    digest = hashlib.sha256()
+    with open(ruta, 'rb') as archivo:
+        for bloque in iter(lambda: archivo.read(1024 * 1024), b''):
+            digest.update(bloque)
+    return digest.hexdigest()
+
+def guardar_blob(job, ruta, sha256):
+    """Extrae e indexa un archivo nuevo; si otro proceso ya lo guardó, reutiliza ese blob."""
+    fragmentos = dividir_en_fragmentos(extraer_texto(job, ruta, job.filename.rsplit('.', 1)[1].lower()))
+    blob = DocumentBlob(sha256=sha256, size=os.path.getsize(ruta), ref_count=0)
+    db.session.add(blob)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        return DocumentBlob.query.filter_by(sha256=sha256).one()
+    db.session.add_all(
+        DocumentChunk(blob_id=blob.id, position=posicion, content=fragmento)
+        for posicion, fragmento in enumerate(fragmentos)
+    )
+    return blob
+
+def vincular_documento(job, blob):
+    """Asocia el blob al usuario del trabajo y deja la referencia en su historial."""
+    db.session.add(UserDocument(user_id=job.user_id, blob_id=blob.id, filename=job.filename))
+    DocumentBlob.query.filter_by(id=blob.id).update({DocumentBlob.ref_count: DocumentBlob.ref_count + 1})
+    total_fragmentos = DocumentChunk.query.filter_by(blob_id=blob.id).count()
+
+    # El contenido vive en los fragmentos; en el historial solo queda una referencia
+    file_message = Message(
+        user_id=job.user_id,
+        role='user',
+        content=f"[Archivo Subido: {job.filename}] ({total_fragmentos} fragmentos indexados)"
+    )
+    confirmation_msg = Message(
+        user_id=job.user_id,
+        role='system',
+        content="Información del archivo procesada. Recuerda: has leído y comprendido el contenido del archivo subido."
+    )
+    db.session.add_all([file_message, confirmation_msg])
+    _actualizar_trabajo(job, status='listo')
+
+def procesar_subida(job_id, ruta, sha256):
+    """Tarea en segundo plano: extrae el archivo y lo guarda como mensajes del usuario."""
+    with app.app_context():
+        job = db.session.get(UploadJob, job_id)
+        try:
+            _actualizar_trabajo(job, status='procesando')
+            blob = DocumentBlob.query.filter_by(sha256=sha256).first() or guardar_blob(job, ruta, sha256)
+            vincular_documento(job, blob)
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error al procesar el archivo {job.filename}: {e}")
+            _actualizar_trabajo(job, status='error', error="Error al procesar el archivo.")
+        finally:
+            _borrar_spool(job_id)
+
 @app.route('/upload', methods=['POST'])
 @login_required
 def upload():
@@ -370,57 +2364,278 @@ def upload():
 
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        file_extension = filename.rsplit('.', 1)[1].lower()
+        job = UploadJob(id=uuid.uuid4().hex, user_id=current_user.id, filename=filename)
         try:
-            if file_extension == 'pdf':
-                try:
-                    pdf_reader = PyPDF2.PdfReader(file)
-                    text = ""
-                    for page in pdf_reader.pages:
-                        page_text = page.extract_text()
-                        if page_text:
-                            text += page_text + "\n"
-                    file_content = text if text.strip() != "" else "No se pudo extraer texto del PDF."
-                except Exception as e:
-                    app.logger.error(f"Error al procesar el PDF: {e}")
-                    return jsonify({"error": "Error al procesar el archivo PDF."}), 500
-            elif file_extension == 'docx':
-                try:
-                    doc = Document(file)
-                    text = ""
-                    for para in doc.paragraphs:
-                        text += para.text + "\n"
-                    file_content = text if text.strip() != "" else "No se pudo extraer texto del archivo DOCX."
-                except Exception as e:
-                    app.logger.error(f"Error al procesar el DOCX: {e}")
-                    return jsonify({"error": "Error al procesar el archivo DOCX."}), 500
-            else:
-                file_content = file.read().decode('utf-8')
+            os.makedirs(app.config['UPLOAD_SPOOL_DIR'], exist_ok=True)
+            ruta = os.path.join(app.config['UPLOAD_SPOOL_DIR'], job.id)
+            file.save(ruta)
+            sha256 = _sha256_archivo(ruta)
         except Exception as e:
             app.logger.error(f"Error leyendo el archivo: {e}")
             return jsonify({"error": "Error al leer el archivo."}), 500
 
-        # Se guarda el contenido extraído en la base de datos como mensaje (para el contexto de GPT)
-        file_message = Message(
-            user_id=current_user.id,
-            role='user',
-            content=f"[Archivo Subido: {filename}]\n\n{file_content}"
-        )
-        db.session.add(file_message)
+        db.session.add(job)
+        blob = DocumentBlob.query.filter_by(sha256=sha256).first()
+        if blob:
+            # Archivo ya conocido: no se vuelve a extraer ni a almacenar
+            os.remove(ruta)
+            vincular_documento(job, blob)
+        else:
+            db.session.commit()
+            _coordinador_subidas.submit(procesar_subida, job.id, ruta, sha256)
+
+        return jsonify({"job_id": job.id, "status": job.status}), 202
+    else:
+        return jsonify({"error": "Tipo de archivo no permitido. Solo se permiten archivos de texto (.txt, .md), PDF (.pdf) y DOCX (.docx)."}), 400
+
+@app.route('/upload/<job_id>', methods=['GET'])
+@login_required
+def upload_status(job_id):
+    descartar_subidas_huerfanas(job_id)
+    job = UploadJob.query.filter_by(id=job_id, user_id=current_user.id).first()
+    if job is None:
+        return jsonify({"error": "Subida no encontrada."}), 404
+
+    respuesta = {
+        "job_id": job.id,
+        "filename": job.filename,
+        "status": job.status,
+        "pages_total": job.pages_total,
+        "pages_done": job.pages_done
+    }
+    if job.status == 'listo':
+        respuesta["message"] = "Archivo subido correctamente."
+    elif job.status == 'error':
+        respuesta["error"] = job.error
+    return jsonify(respuesta)
+
+##############################################
+# Retención y archivo de mensajes            #
+##############################################
+
+def comprimir(datos):
+    """Devuelve (codec, bytes comprimidos); zstd si está instalado, si no zlib."""
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=10).compress(datos)
+    return 'zlib', zlib.compress(datos, 9)
+
+def descomprimir(codec, datos):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("El archivo de mensajes está comprimido con zstd y el paquete zstandard no está instalado")
+        return zstandard.ZstdDecompressor().decompress(datos)
+    return zlib.decompress(datos)
+
+def _borrar_en_lotes(consulta_ids, modelo, lote):
+    """Borra por lotes de ids con un commit por lote, para no bloquear rangos grandes."""
+    total = 0
+    while True:
+        ids = [fila.id for fila in consulta_ids.limit(lote)]
+        if not ids:
+            return total
+        modelo.query.filter(modelo.id.in_(ids)).delete(synchronize_session=False)
         db.session.commit()
+        total += len(ids)
 
-        confirmation_msg = Message(
-            user_id=current_user.id,
-            role='system',
-            content="Información del archivo procesada. Recuerda: has leído y comprendido el contenido del archivo subido."
+def borrar_historial(user_id):
+    """Borra la conversación del usuario (/clear): puntos clave, resumen, archivos y mensajes.
+
+    Los mensajes se borran en lotes de BORRADO_LOTE, cada uno en su transacción;
+    repetir /clear tras un error termina lo que haya quedado.
+    """
+    lote = app.config['BORRADO_LOTE']
+    # key_point.message_id apunta a message: los puntos clave se borran antes (Postgres lo exige)
+    _borrar_en_lotes(db.session.query(KeyPoint.id).filter(KeyPoint.user_id == user_id), KeyPoint, lote)
+    ConversationSummary.query.filter_by(user_id=user_id).delete()
+    MessageArchive.query.filter_by(user_id=user_id).delete()
+    liberar_documentos(user_id)
+    db.session.commit()
+    _borrar_en_lotes(
+        db.session.query(Message.id).filter(Message.user_id == user_id, Message.role != 'system'),
+        Message, lote
+    )
+
+def mensajes_archivados(user_id):
+    """Mensajes archivados del usuario en orden de id, con los mismos campos que `message`."""
+    ultimo = 0
+    while True:
+        archivo = MessageArchive.query.filter(
+            MessageArchive.user_id == user_id,
+            MessageArchive.first_message_id > ultimo
+        ).order_by(MessageArchive.first_message_id.asc()).first()
+        if archivo is None:
+            return
+        for linea in descomprimir(archivo.codec, archivo.payload).splitlines():
+            fila = json.loads(linea)
+            fila['timestamp'] = datetime.fromisoformat(fila['timestamp']) if fila['timestamp'] else None
+            yield SimpleNamespace(**fila)
+        ultimo = archivo.first_message_id
+
+def archivar_lote(limite_fecha, desde_id, lote):
+    """Mueve a message_archive hasta `lote` mensajes anteriores a `limite_fecha`.
+
+    Con el modo memoria activo solo toma mensajes ya plegados en el resumen del
+    usuario, para que no pierda contexto; sin resumen todavía, no toma ninguno.
+    Los puntos clave se conservan sin el vínculo al mensaje. Devuelve
+    (mensajes archivados, último id visto).
+    """
+    filas = db.session.query(
+        Message.id, Message.user_id, Message.role, Message.content, Message.timestamp
+    ).join(
+        User, User.id == Message.user_id
+    ).outerjoin(
+        ConversationSummary, ConversationSummary.user_id == Message.user_id
+    ).filter(
+        Message.id > desde_id,
+        Message.timestamp < limite_fecha,
+        db.or_(
+            db.and_(ConversationSummary.id.is_(None), User.memory_mode.isnot(True)),
+            Message.id <= ConversationSummary.last_message_id
         )
-        db.session.add(confirmation_msg)
+    ).order_by(Message.id.asc()).limit(lote).all()
+    if not filas:
+        return 0, desde_id
+
+    por_usuario = {}
+    for fila in filas:
+        por_usuario.setdefault(fila.user_id, []).append(fila)
+    for user_id, mensajes in por_usuario.items():
+        codec, payload = comprimir("\n".join(json.dumps({
+            "id": msg.id,
+            "role": msg.role,
+            "content": msg.content,
+            "timestamp": msg.timestamp.isoformat() if msg.timestamp else None
+        }, ensure_ascii=False) for msg in mensajes).encode('utf-8'))
+        fechas = [msg.timestamp for msg in mensajes if msg.timestamp]
+        db.session.add(MessageArchive(
+            user_id=user_id,
+            first_message_id=mensajes[0].id,
+            last_message_id=mensajes[-1].id,
+            message_count=len(mensajes),
+            oldest=min(fechas, default=None),
+            newest=max(fechas, default=None),
+            codec=codec,
+            payload=payload
+        ))
+
+    ids = [fila.id for fila in filas]
+    KeyPoint.query.filter(KeyPoint.message_id.in_(ids)).update(
+        {KeyPoint.message_id: None}, synchronize_session=False
+    )
+    Message.query.filter(Message.id.in_(ids)).delete(synchronize_session=False)
+    db.session.commit()
+    return len(ids), ids[-1]
+
+##############################################
+# Comandos de administración (flask ...)     #
+##############################################
+
+@app.cli.command('publicar-prompt')
+@click.argument('archivo', type=click.File('r', encoding='utf-8'))
+@click.option('--nombre', default=PROMPT_SISTEMA_GLOBAL, help="Plantilla a versionar (por defecto, la global).")
+def publicar_prompt(archivo, nombre):
+    """Publica una nueva versión de una plantilla de prompt de sistema."""
+    ultima = db.session.query(db.func.max(PromptTemplate.version)).filter_by(name=nombre).scalar() or 0
+    db.session.add(PromptTemplate(name=nombre, version=ultima + 1, content=archivo.read()))
+    db.session.commit()
+    _cache_prompts.pop(nombre, None)
+    click.echo(f"Plantilla '{nombre}' publicada como versión {ultima + 1}.")
+
+@app.cli.command('backfill-puntos-clave')
+@click.option('--lote', default=1000, help="Mensajes procesados por transacción.")
+def backfill_puntos_clave(lote):
+    """Extrae los puntos clave de las respuestas guardadas antes de existir key_point."""
+    ultimo_id, total = 0, 0
+    while True:
+        mensajes = Message.query.filter(
+            Message.id > ultimo_id,
+            Message.role == 'assistant',
+            Message.content.like('%### Punto clave%'),
+            ~db.exists().where(KeyPoint.message_id == Message.id)
+        ).order_by(Message.id.asc()).limit(lote).all()
+        if not mensajes:
+            break
+        for msg in mensajes:
+            agregar_puntos_clave(msg)
         db.session.commit()
+        ultimo_id = mensajes[-1].id
+        total += len(mensajes)
+        click.echo(f"{total} mensajes procesados")
+    click.echo("Backfill de puntos clave completo.")
+
+@app.cli.command('descargar-recursos')
+def descargar_recursos():
+    """Copia MathJax y Font Awesome a static/vendor (gunicorn lo ejecuta al arrancar si faltan)."""
+    for nombre, (paquete, version, rutas) in BIBLIOTECAS.items():
+        destino = os.path.join(app.static_folder, 'vendor', f"{nombre}-{version}")
+        if os.path.isdir(destino):
+            click.echo(f"{nombre} {version} ya está en {destino}")
+            continue
+        with urllib.request.urlopen(f"{REGISTRO_NPM}/{paquete}/{version}", timeout=60) as r:
+            dist = json.load(r)['dist']
+        with urllib.request.urlopen(dist['tarball'], timeout=300) as r:
+            datos = r.read()
+        algoritmo, esperado = dist['integrity'].split('-', 1)
+        if base64.b64encode(hashlib.new(algoritmo, datos).digest()).decode() != esperado:
+            raise click.ClickException(f"La integridad de {paquete}@{version} no coincide con la del registro")
+
+        # Se extrae a un directorio temporal y se renombra al final: nunca queda a medias
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        temporal = tempfile.mkdtemp(dir=os.path.dirname(destino))
+        os.chmod(temporal, 0o755)
+        with tarfile.open(fileobj=io.BytesIO(datos)) as tar:
+            for miembro in tar.getmembers():
+                ruta = miembro.name.split('/', 1)[-1]  # Los paquetes de npm vienen bajo package/
+                if miembro.isfile() and ruta.startswith(rutas) and '..' not in ruta.split('/'):
+                    salida = os.path.join(temporal, ruta)
+                    os.makedirs(os.path.dirname(salida), exist_ok=True)
+                    with tar.extractfile(miembro) as origen, open(salida, 'wb') as f:
+                        shutil.copyfileobj(origen, f)
+        os.replace(temporal, destino)
+        click.echo(f"{nombre} {version} descargado en {destino}")
+
+@app.cli.command('archivar-mensajes')
+@click.option('--dias', default=None, type=int, help="Antigüedad mínima (por defecto, RETENCION_DIAS).")
+@click.option('--lote', default=None, type=int, help="Mensajes por transacción (por defecto, BORRADO_LOTE).")
+@click.option('--presupuesto', default=300.0, help="Segundos máximos de trabajo; lo pendiente queda para la próxima ejecución.")
+@click.option('--pausa', default=0.05, help="Segundos entre lotes, para dejar pasar a otras escrituras.")
+@click.option('--compactar', is_flag=True, help="Al terminar, VACUUM ANALYZE en Postgres (ANALYZE en SQLite).")
+def archivar_mensajes(dias, lote, presupuesto, pausa, compactar):
+    """Archiva comprimidos los mensajes antiguos y los borra de la tabla `message`.
 
-        # Nota: Si no deseas mostrar el contenido del archivo en el chat, solo responde un mensaje de confirmación.
-        return jsonify({"message": "Archivo subido correctamente.", "content": file_content})
+    Pensado para un cron diario: trabaja por lotes cortos hasta agotar el
+    presupuesto de tiempo y se puede interrumpir en cualquier momento.
+    """
+    limite_fecha = datetime.utcnow() - timedelta(days=dias if dias is not None else app.config['RETENCION_DIAS'])
+    lote = lote or app.config['BORRADO_LOTE']
+    fin = time.monotonic() + presupuesto
+    ultimo_id, total = 0, 0
+    while time.monotonic() < fin:
+        archivados, ultimo_id = archivar_lote(limite_fecha, ultimo_id, lote)
+        if not archivados:
+            break
+        total += archivados
+        click.echo(f"{total} mensajes archivados")
+        time.sleep(pausa)
     else:
-        return jsonify({"error": "Tipo de archivo no permitido. Solo se permiten archivos de texto (.txt, .md), PDF (.pdf) y DOCX (.docx)."}), 400
+        click.echo("Presupuesto de tiempo agotado; el resto se archivará en la próxima ejecución.")
+    click.echo(f"Archivo completo: {total} mensajes anteriores a {limite_fecha:%Y-%m-%d} ({'zstd' if zstandard else 'zlib'}).")
+
+    if compactar:
+        # VACUUM actualiza el mapa de visibilidad: sin él Postgres no usa index-only scans
+        sentencia = "VACUUM (ANALYZE) message" if db.engine.dialect.name == 'postgresql' else "ANALYZE message"
+        with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conexion:
+            conexion.execute(text(sentencia))
+        click.echo(f"{sentencia} ejecutado.")
+
+# Al arrancar cada worker se limpian las subidas que quedaron colgadas en un proceso
+# anterior. Durante `flask db upgrade` la tabla puede no existir todavía.
+with app.app_context():
+    try:
+        descartar_subidas_huerfanas()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.info(f"No se revisaron las subidas pendientes: {e}")
 
 if __name__ == '__main__':
     with app.app_context():
@@ -0,0 +1,118 @@
+"""Prueba de carga de /chat: mide cuántas conversaciones atiende el servidor a la vez.
+
+Uso:
+    python bench/carga_chat.py --url http://localhost:8000 --concurrencia 50 --peticiones 200
+
+Cada cliente concurrente registra (si hace falta) e inicia sesión con su propio
+usuario y envía mensajes a /chat. Para comparar antes/después, levantar el
+servidor con GUNICORN_WORKER_CLASS=sync y con el valor por defecto (gevent),
+apuntando OPENAI_BASE_URL a bench/openai_simulado.py para no consumir la API real.
+
+Mientras dura la carga, un cliente aparte inicia sesión cada --sondeo segundos y
+mide cuánto tarda /login. Con un modelo lento y más chats en curso que conexiones
+en el pool (DB_POOL_SIZE + DB_MAX_OVERFLOW, 10 + 20 con gevent), /login solo sigue
+respondiendo rápido si los chats no retienen su conexión mientras esperan al modelo:
+
+    python bench/openai_simulado.py --latencia 5 &
+    OPENAI_BASE_URL=http://127.0.0.1:8099/v1 OPENAI_API_KEY=simulado WEB_CONCURRENCY=1 gunicorn app:app &
+    python bench/carga_chat.py --concurrencia 60 --peticiones 120
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def abrir_sesion(url, usuario, password):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+    datos = urllib.parse.urlencode({"username": usuario, "password": password}).encode()
+    opener.open(f"{url}/register", datos).read()
+    opener.open(f"{url}/login", datos).read()
+    return opener
+
+
+def enviar(opener, url, mensaje):
+    cuerpo = json.dumps({"message": mensaje}).encode()
+    peticion = urllib.request.Request(f"{url}/chat", cuerpo, {"Content-Type": "application/json"})
+    inicio = time.perf_counter()
+    with opener.open(peticion) as respuesta:
+        respuesta.read()
+    return time.perf_counter() - inicio
+
+
+def sondear_login(url, password, intervalo, parar):
+    """Inicia sesión cada `intervalo` segundos hasta que `parar` se activa; devuelve (latencias, errores)."""
+    abrir_sesion(url, "carga-sondeo", password)
+    datos = urllib.parse.urlencode({"username": "carga-sondeo", "password": password}).encode()
+    latencias, errores = [], 0
+    while not parar.wait(intervalo):
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+        inicio = time.perf_counter()
+        try:
+            opener.open(f"{url}/login", datos).read()
+        except (urllib.error.URLError, OSError):
+            errores += 1
+            continue
+        latencias.append(time.perf_counter() - inicio)
+    return latencias, errores
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--concurrencia", type=int, default=20)
+    parser.add_argument("--peticiones", type=int, default=100)
+    parser.add_argument("--mensaje", default="Explícame la ley de Ohm")
+    parser.add_argument("--password", default="carga-password")
+    parser.add_argument("--sondeo", type=float, default=0.5, help="segundos entre logins de prueba (0 lo desactiva)")
+    args = parser.parse_args()
+
+    with ThreadPoolExecutor(args.concurrencia + 1) as pool:
+        sesiones = list(pool.map(
+            lambda i: abrir_sesion(args.url, f"carga{i}", args.password), range(args.concurrencia)
+        ))
+
+        parar = threading.Event()
+        sondeo = pool.submit(sondear_login, args.url, args.password, args.sondeo, parar) if args.sondeo else None
+        inicio = time.perf_counter()
+        try:
+            latencias = list(pool.map(
+                lambda i: enviar(sesiones[i % args.concurrencia], args.url, args.mensaje),
+                range(args.peticiones)
+            ))
+        finally:
+            parar.set()
+        total = time.perf_counter() - inicio
+
+    resultado = {
+        "concurrencia": args.concurrencia,
+        "peticiones": args.peticiones,
+        "duracion_s": round(total, 3),
+        "throughput_rps": round(args.peticiones / total, 2),
+        "p50_s": round(statistics.median(latencias), 3),
+        "p95_s": round(percentil(latencias, 95), 3),
+    }
+    if sondeo is not None:
+        latencias_login, errores_login = sondeo.result()
+        resultado["login_durante_carga"] = {
+            "intentos": len(latencias_login) + errores_login,
+            "errores": errores_login,
+            "p50_s": round(statistics.median(latencias_login), 3) if latencias_login else None,
+            "max_s": round(max(latencias_login), 3) if latencias_login else None,
+        }
+    print(json.dumps(resultado, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Benchmark de las consultas calientes sobre la tabla `message`.
+
+Uso:
+    python bench/consultas_message.py --url postgresql://.../bench --filas 10000000 --usuarios 20000
+    python bench/consultas_message.py --url postgresql://.../bench --sin-indices   # línea base
+    python bench/consultas_message.py --filas 200000 --usuarios 500   # SQLite temporal
+
+Siembra (una sola vez) la tabla con `--filas` mensajes repartidos entre
+`--usuarios` usuarios y mide el tiempo por petición de cada consulta que usan
+/chat, /export, /resumen y /clear para un usuario al azar. Con --sin-indices se
+eliminan los índices compuestos antes de medir, para comparar con la versión
+anterior del esquema, y se vuelven a crear al terminar.
+
+La base es siempre una aparte: --url, o sin ella un SQLite temporal. Se rechaza la
+base configurada para la aplicación (DATABASE_URL), que nunca debe recibir las
+filas sembradas ni perder sus índices.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+RAIZ = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, RAIZ)
+
+from sqlalchemy import insert, text  # noqa: E402
+from sqlalchemy.engine import make_url  # noqa: E402
+
+LOTE = 50_000
+
+
+def _normalizar(url):
+    url = make_url(url.replace("postgres://", "postgresql://", 1))
+    if url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:"):
+        # Flask-SQLAlchemy resuelve las rutas relativas de SQLite dentro de instance/
+        ruta = url.database if os.path.isabs(url.database) else os.path.join(RAIZ, "instance", url.database)
+        url = url.set(database=os.path.realpath(ruta))
+    return url.render_as_string(hide_password=False)
+
+
+def preparar_base(url):
+    """Apunta la aplicación a `url` (o a un SQLite temporal) antes de importarla."""
+    configurada = os.environ.get("DATABASE_URL", "sqlite:///conversations.db")
+    if url is None:
+        url = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='profai-consultas-'), 'bench.db')}"
+    elif _normalizar(url) == _normalizar(configurada):
+        sys.exit("--url apunta a la base de la aplicación (DATABASE_URL); usa una base aparte")
+    os.environ["DATABASE_URL"] = url
+    os.environ.pop("DATABASE_REPLICA_URL", None)
+    return url
+
+
+def sembrar(filas, usuarios):
+    from app import db, User, Message
+
+    if db.session.query(Message.id).limit(1).first() is not None:
+        return
+    db.session.execute(insert(User), [
+        {"id": i, "username": f"bench{i}", "password": "x", "memory_mode": False}
+        for i in range(1, usuarios + 1)
+    ])
+    inicio = datetime(2025, 1, 1)
+    roles = ("user", "assistant")
+    for desde in range(0, filas, LOTE):
+        db.session.execute(insert(Message), [
+            {
+                "user_id": n % usuarios + 1,
+                "role": "system" if n < usuarios else roles[n % 2],
+                "content": "### Punto clave\nContenido de prueba" if n % 10 == 0 else "Contenido de prueba",
+                "timestamp": inicio + timedelta(seconds=n),
+            }
+            for n in range(desde, min(desde + LOTE, filas))
+        ])
+        db.session.commit()
+        print(f"sembradas {min(desde + LOTE, filas)}/{filas}", file=sys.stderr)
+
+
+def consultas(user_id):
+    from app import Message
+
+    por_usuario = Message.query.filter(Message.user_id == user_id)
+    return {
+        "chat_system": lambda: por_usuario.filter(Message.role == "system").order_by(Message.timestamp.asc()).first(),
+        "chat_ultimo": lambda: por_usuario.order_by(Message.timestamp.desc()).first(),
+        "chat_memoria": lambda: por_usuario.order_by(Message.timestamp.desc()).limit(200).all(),
+        "export": lambda: por_usuario.filter(Message.role != "system").order_by(Message.timestamp.asc()).all(),
+        "resumen": lambda: por_usuario.filter(
+            Message.role == "assistant", Message.content.like("%### Punto clave%")
+        ).order_by(Message.timestamp.asc()).all(),
+        "clear_conteo": lambda: por_usuario.filter(Message.role != "system").count(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--filas", type=int, default=10_000_000)
+    parser.add_argument("--usuarios", type=int, default=20_000)
+    parser.add_argument("--repeticiones", type=int, default=200)
+    parser.add_argument("--sin-indices", action="store_true")
+    parser.add_argument("--url", help="base de datos del benchmark (por defecto, un SQLite temporal)")
+    args = parser.parse_args()
+
+    url = preparar_base(args.url)
+    print(f"base del benchmark: {make_url(url).render_as_string()}", file=sys.stderr)
+    from app import app, db, Message
+
+    with app.app_context():
+        db.create_all()
+        sembrar(args.filas, args.usuarios)
+        indices = list(Message.__table__.indexes) if args.sin_indices else []
+        for indice in indices:
+            db.session.execute(text(f"DROP INDEX IF EXISTS {indice.name}"))
+        db.session.commit()
+
+        tiempos = {}
+        try:
+            for _ in range(args.repeticiones):
+                for nombre, consulta in consultas(random.randint(1, args.usuarios)).items():
+                    inicio = time.perf_counter()
+                    consulta()
+                    tiempos.setdefault(nombre, []).append((time.perf_counter() - inicio) * 1000)
+                db.session.rollback()
+        finally:
+            db.session.rollback()
+            for indice in indices:
+                indice.create(db.engine, checkfirst=True)
+
+    print(json.dumps({
+        nombre: {
+            "p50_ms": round(statistics.median(valores), 3),
+            "p95_ms": round(sorted(valores)[int(len(valores) * 0.95) - 1], 3),
+        }
+        for nombre, valores in tiempos.items()
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
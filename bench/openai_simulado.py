@@ -0,0 +1,127 @@
+"""Servidor local que imita /v1/chat/completions de OpenAI para pruebas sin red.
+
+Uso:
+    python bench/openai_simulado.py --puerto 8099 --latencia 0.3 --tokens-por-segundo 80
+    OPENAI_BASE_URL=http://127.0.0.1:8099/v1 OPENAI_API_KEY=simulado gunicorn app:app
+
+Responde con un texto fijo de --tokens-salida tokens (incluye un "### Punto clave"
+para que /resumen tenga datos). --latencia es el tiempo hasta el primer token y
+--tokens-por-segundo el ritmo de generación; con "stream": true se envían los
+tokens como eventos SSE con el mismo formato que la API real, incluido el chunk
+final de uso cuando se pide stream_options.include_usage.
+"""
+import argparse
+import json
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TEXTO_BASE = (
+    "La ley de Ohm relaciona la tensión, la corriente y la resistencia de un circuito. "
+    "### Punto clave\nV = I · R, por lo que duplicar la resistencia reduce la corriente a la mitad. "
+)
+
+
+def generar_tokens(cantidad):
+    palabras = TEXTO_BASE.split(" ")
+    return [palabras[i % len(palabras)] + " " for i in range(cantidad)]
+
+
+class Manejador(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+
+    def log_message(self, formato, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        cuerpo = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        tokens_entrada = sum(len(str(m.get("content", ""))) for m in cuerpo.get("messages", [])) // 4
+        tokens = generar_tokens(min(self.config.tokens_salida, cuerpo.get("max_tokens") or self.config.tokens_salida))
+        uso = {
+            "prompt_tokens": tokens_entrada,
+            "completion_tokens": len(tokens),
+            "total_tokens": tokens_entrada + len(tokens),
+        }
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex}", "created": int(time.time()), "model": cuerpo.get("model")}
+
+        time.sleep(self.config.latencia)
+        if cuerpo.get("stream"):
+            self.responder_stream(base, tokens, uso, (cuerpo.get("stream_options") or {}).get("include_usage"))
+        else:
+            time.sleep(len(tokens) / self.config.tokens_por_segundo)
+            self.responder_json(base, "".join(tokens), uso)
+
+    def responder_json(self, base, texto, uso):
+        datos = json.dumps({
+            **base,
+            "object": "chat.completion",
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": texto},
+                "finish_reason": "stop",
+            }],
+            "usage": uso,
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(datos)))
+        self.end_headers()
+        self.wfile.write(datos)
+
+    def responder_stream(self, base, tokens, uso, incluir_uso):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def enviar(carga):
+            datos = f"data: {carga}\n\n".encode()
+            self.wfile.write(f"{len(datos):x}\r\n".encode() + datos + b"\r\n")
+            self.wfile.flush()
+
+        def chunk(delta, fin=None):
+            return {**base, "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": fin}]}
+
+        pausa = 1 / self.config.tokens_por_segundo
+        enviar(json.dumps(chunk({"role": "assistant", "content": ""})))
+        for token in tokens:
+            time.sleep(pausa)
+            enviar(json.dumps(chunk({"content": token})))
+        enviar(json.dumps(chunk({}, "stop")))
+        if incluir_uso:
+            enviar(json.dumps({**base, "object": "chat.completion.chunk", "choices": [], "usage": uso}))
+        enviar("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def crear_servidor(puerto, latencia=0.3, tokens_por_segundo=80.0, tokens_salida=200):
+    config = argparse.Namespace(latencia=latencia, tokens_por_segundo=tokens_por_segundo, tokens_salida=tokens_salida)
+    manejador = type("ManejadorConfigurado", (Manejador,), {"config": config})
+    servidor = ThreadingHTTPServer(("127.0.0.1", puerto), manejador)
+    servidor.daemon_threads = True
+    return servidor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--puerto", type=int, default=8099)
+    parser.add_argument("--latencia", type=float, default=0.3, help="segundos hasta el primer token")
+    parser.add_argument("--tokens-por-segundo", type=float, default=80.0)
+    parser.add_argument("--tokens-salida", type=int, default=200)
+    args = parser.parse_args()
+
+    servidor = crear_servidor(args.puerto, args.latencia, args.tokens_por_segundo, args.tokens_salida)
+    print(f"OpenAI simulado en http://127.0.0.1:{args.puerto}/v1", flush=True)
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Benchmark de recuperación de fragmentos (`buscar_fragmentos`).
+
+Uso:
+    DATABASE_URL=sqlite:///bench.db python bench/recuperacion_fragmentos.py --fragmentos 100000
+
+Siembra (una sola vez) `--fragmentos` fragmentos de texto sintético repartidos
+entre `--usuarios` usuarios y mide la latencia de recuperación top-k con
+consultas al azar. Funciona contra SQLite (FTS5) y Postgres (tsvector).
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from sqlalchemy import insert  # noqa: E402
+
+from app import app, db, User, DocumentBlob, UserDocument, DocumentChunk, buscar_fragmentos  # noqa: E402
+
+LOTE = 5_000
+TAM_VOCABULARIO = 30_000
+
+
+def vocabulario():
+    # Palabras sintéticas con frecuencias tipo Zipf, como en texto real
+    rng = random.Random(0)
+    letras = "abcdefghijklmnopqrstuvwxyzáéíóúñ"
+    palabras = ["".join(rng.choice(letras) for _ in range(rng.randint(3, 10))) for _ in range(TAM_VOCABULARIO)]
+    pesos = [1 / rango for rango in range(1, TAM_VOCABULARIO + 1)]
+    return palabras, pesos
+
+
+VOCABULARIO, PESOS = vocabulario()
+
+
+def parrafo(rng, palabras=300):
+    return " ".join(rng.choices(VOCABULARIO, PESOS, k=palabras))
+
+
+def sembrar(fragmentos, usuarios):
+    if db.session.query(DocumentChunk.id).limit(1).first() is not None:
+        return
+    rng = random.Random(1)
+    db.session.execute(insert(User), [
+        {"id": i, "username": f"bench{i}", "password": "x", "memory_mode": False}
+        for i in range(1, usuarios + 1)
+    ])
+    # Archivos de 200 fragmentos, cada uno subido por un usuario
+    archivos = (fragmentos + 199) // 200
+    db.session.execute(insert(DocumentBlob), [
+        {"id": i, "sha256": f"{i:064x}", "size": 0, "ref_count": 1} for i in range(1, archivos + 1)
+    ])
+    db.session.execute(insert(UserDocument), [
+        {"user_id": i % usuarios + 1, "blob_id": i, "filename": f"apunte{i}.pdf"} for i in range(1, archivos + 1)
+    ])
+    for desde in range(0, fragmentos, LOTE):
+        db.session.execute(insert(DocumentChunk), [
+            {"blob_id": n // 200 + 1, "position": n % 200, "content": parrafo(rng)}
+            for n in range(desde, min(desde + LOTE, fragmentos))
+        ])
+        db.session.commit()
+        print(f"sembrados {min(desde + LOTE, fragmentos)}/{fragmentos}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fragmentos", type=int, default=100_000)
+    parser.add_argument("--usuarios", type=int, default=10)
+    parser.add_argument("--consultas", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(2)
+    with app.app_context():
+        db.create_all()
+        sembrar(args.fragmentos, args.usuarios)
+        motor = db.engine.dialect.name
+
+        latencias = []
+        for _ in range(args.consultas):
+            # Las ~100 palabras más frecuentes hacen de palabras vacías; las consultas usan el resto
+            consulta = "Explícame " + " ".join(rng.choices(VOCABULARIO[100:], PESOS[100:], k=4))
+            inicio = time.perf_counter()
+            buscar_fragmentos(rng.randint(1, args.usuarios), consulta, k=args.k)
+            latencias.append((time.perf_counter() - inicio) * 1000)
+
+    print(json.dumps({
+        "motor": motor,
+        "fragmentos": args.fragmentos,
+        "fragmentos_por_usuario": args.fragmentos // args.usuarios,
+        "p50_ms": round(statistics.median(latencias), 3),
+        "p95_ms": round(sorted(latencias)[int(len(latencias) * 0.95) - 1], 3),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
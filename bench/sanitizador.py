@@ -0,0 +1,253 @@
+"""Micro-benchmark y corpus de regresión del sanitizador de respuestas.
+
+Uso:
+    python bench/sanitizador.py                 # corpus + fuzz + benchmark
+    python bench/sanitizador.py --fuzz 20000 --repeticiones 50 --salida bench/resultados_sanitizador.json
+
+1. Corpus: cada vector XSS conocido de CORPUS debe quedar inerte y el resultado
+   por fragmentos (stream) debe ser idéntico al de la respuesta completa.
+2. Fuzz: textos aleatorios armados con piezas peligrosas, cortados en fragmentos
+   de tamaño aleatorio; mismas comprobaciones.
+3. Benchmark: respuestas de ~100 KB, completas y en fragmentos de ~20 caracteres
+   (el tamaño típico de un delta de OpenAI), con la implementación anterior
+   (varias regex y re-escaneo del pendiente) y la actual.
+
+Sale con código 1 si alguna comprobación falla, para poder usarlo en CI.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+
+RAIZ = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, RAIZ)
+
+from app import sanitizar_markdown, sanitizar_stream  # noqa: E402
+
+# Vectores que, insertados con innerHTML tras processContent (index.html), ejecutarían
+# código si pasaran sin neutralizar. Añadir aquí cada caso nuevo que aparezca.
+CORPUS = [
+    '<script>alert(1)</script>',
+    '<script type="text/javascript">alert(1)</script>',
+    '<SCRIPT SRC=//evil.example/x.js></SCRIPT>',
+    '<script\n>alert(1)</script\n>',
+    '<scr<script></script>ipt>alert(1)</script>',
+    '<img src=x onerror=alert(1)>',
+    '<img src="x" onerror="alert(1)">',
+    '<IMG SRC=x OnErRoR=alert(1)>',
+    '<svg onload=alert(1)>',
+    '<svg/onload=alert(1)>',
+    '<body onload=alert(1)>',
+    '<details open ontoggle=alert(1)>',
+    '<iframe src="javascript:alert(1)"></iframe>',
+    '<iframe srcdoc="<script>alert(1)</script>">',
+    '<object data="data:text/html,<script>alert(1)</script>">',
+    '<embed src=javascript:alert(1)>',
+    '<a href="javascript:alert(1)">clic</a>',
+    '<a href="&#106;avascript:alert(1)">clic</a>',
+    '<a href="java\tscript:alert(1)">clic</a>',
+    '<math><mtext><table><mglyph><style><img src=x onerror=alert(1)>',
+    '<style>@import "//evil.example/x.css";</style>',
+    '<!--><img src=x onerror=alert(1)>-->',
+    '</p><img src=x onerror=alert(1)>',
+    '<<script></script>img src=x onerror=alert(1)>',
+    '![x](javascript:alert(1))',
+    '![x](x" onerror="alert(1))',
+    '![x" onerror="alert(1)](y)',
+    "![x](x' onerror='alert(1))",
+    '![a]<script></script>(x" onerror="alert(1))',
+    '![x](x"><img src=x onerror=alert(1)>)',
+    'JaVaScRiPt:alert(1)',
+    'vbscript:msgbox(1)',
+    'javajavascript:script:alert(1)',
+]
+
+# Texto que no debe cambiar: markdown normal, LaTeX y comparaciones.
+INALTERADOS = [
+    '### Punto clave\n**V = I · R**, la corriente baja a la mitad.',
+    'Si $a < b$ y \\(b < c\\) entonces a < c; también 3 <= 4 y 5 > 2.',
+    '```python\nprint("hola")\n```',
+    '![circuito](https://example.com/circuito.png)',
+    'El esquema "javascript" sin dos puntos no es un problema.',
+]
+
+PIEZAS_FUZZ = [
+    '<', '>', '/', '!', '[', ']', '(', ')', '"', "'", '=', ' ', '\n', 'a', 'x',
+    'script', 'img', 'svg', 'src', 'onerror', 'onload', 'alert(1)',
+    'java', 'script:', 'javascript:', 'JavaScript:', 'vb', 'vbscript:',
+    '<script>', '</script>', '![', '](', '&#106;', '$', '**', '### ',
+]
+
+
+##############################################
+# Implementación anterior (para comparar)     #
+##############################################
+
+def sanitizar_markdown_anterior(texto):
+    texto = re.sub(r'<script>.*?</script>', '', texto, flags=re.DOTALL)
+    texto = re.sub(r'javascript:', '', texto, flags=re.IGNORECASE)
+    return texto
+
+
+def _corte_seguro_anterior(texto):
+    inicio_script = texto.rfind('<script>')
+    if inicio_script != -1 and texto.find('</script>', inicio_script) == -1:
+        return inicio_script
+    minusculas = texto.lower()
+    for i in range(max(0, len(texto) - len('javascript:') + 1), len(texto)):
+        sufijo = minusculas[i:]
+        if 'javascript:'.startswith(sufijo) or '<script>'.startswith(texto[i:]):
+            return i
+    return len(texto)
+
+
+def sanitizar_stream_anterior(fragmentos):
+    pendiente = ""
+    for fragmento in fragmentos:
+        pendiente += fragmento
+        corte = _corte_seguro_anterior(pendiente)
+        if corte:
+            seguro = sanitizar_markdown_anterior(pendiente[:corte])
+            pendiente = pendiente[corte:]
+            if seguro:
+                yield seguro
+    if pendiente:
+        yield sanitizar_markdown_anterior(pendiente)
+
+
+##############################################
+# Comprobaciones                             #
+##############################################
+
+_ETIQUETA_VIVA = re.compile(r'<[a-z/!?]', re.IGNORECASE)
+_ESQUEMA_VIVO = re.compile(r'(?:java|vb)script:', re.IGNORECASE)
+# Lo que processContent convierte en <img src="$2" alt="$1">
+_IMAGEN_JS = re.compile(r'!\[(.*?)\]\((.*?)\)')
+
+
+def problemas(salida):
+    """Motivos por los que `salida` no sería segura al pasar por processContent + innerHTML."""
+    encontrados = []
+    if _ETIQUETA_VIVA.search(salida):
+        encontrados.append("etiqueta HTML sin escapar")
+    if _ESQUEMA_VIVO.search(salida):
+        encontrados.append("esquema javascript:/vbscript: sin neutralizar")
+    for imagen in _IMAGEN_JS.finditer(salida):
+        if '"' in imagen.group(1) or '"' in imagen.group(2):
+            encontrados.append("comilla dentro de una imagen markdown")
+    return encontrados
+
+
+def fragmentar(texto, rng, maximo=24):
+    i = 0
+    while i < len(texto):
+        paso = rng.randint(1, maximo)
+        yield texto[i:i + paso]
+        i += paso
+
+
+def comprobar(texto, rng):
+    salida = sanitizar_markdown(texto)
+    fallos = problemas(salida)
+    por_partes = "".join(sanitizar_stream(fragmentar(texto, rng)))
+    if por_partes != salida:
+        fallos.append("el stream no coincide con la respuesta completa")
+    return fallos
+
+
+def ejecutar_corpus(rng):
+    fallos = []
+    for vector in CORPUS:
+        fallos += [(vector, motivo) for motivo in comprobar(vector, rng)]
+    for texto in INALTERADOS:
+        if sanitizar_markdown(texto) != texto:
+            fallos.append((texto, "texto legítimo modificado"))
+    return fallos
+
+
+def ejecutar_fuzz(rng, casos):
+    fallos = []
+    for _ in range(casos):
+        texto = "".join(rng.choice(PIEZAS_FUZZ) for _ in range(rng.randint(1, 40)))
+        fallos += [(texto, motivo) for motivo in comprobar(texto, rng)]
+    return fallos
+
+
+##############################################
+# Benchmark                                  #
+##############################################
+
+def respuesta_sintetica(rng, tamano):
+    """Markdown parecido al que devuelve el modelo, con algún vector de vez en cuando."""
+    bloques = INALTERADOS + [
+        "La ley de Ohm relaciona la tensión, la corriente y la resistencia de un circuito. ",
+        "1. Calcula la corriente.\n2. Duplica la resistencia.\n3. Compara los resultados.\n",
+    ]
+    partes, total = [], 0
+    while total < tamano:
+        bloque = rng.choice(CORPUS) if rng.random() < 0.02 else rng.choice(bloques)
+        partes.append(bloque + "\n")
+        total += len(bloque) + 1
+    return "".join(partes)[:tamano]
+
+
+def medir(funcion, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return {"mediana_ms": round(statistics.median(tiempos), 3), "min_ms": round(min(tiempos), 3)}
+
+
+def benchmark(rng, tamano, repeticiones, fragmento):
+    texto = respuesta_sintetica(rng, tamano)
+    fragmentos = [texto[i:i + fragmento] for i in range(0, len(texto), fragmento)]
+    return {
+        "tamano_bytes": len(texto.encode()),
+        "fragmentos": len(fragmentos),
+        "completa": {
+            "anterior": medir(lambda: sanitizar_markdown_anterior(texto), repeticiones),
+            "actual": medir(lambda: sanitizar_markdown(texto), repeticiones),
+        },
+        "stream": {
+            "anterior": medir(lambda: "".join(sanitizar_stream_anterior(fragmentos)), repeticiones),
+            "actual": medir(lambda: "".join(sanitizar_stream(fragmentos)), repeticiones),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fuzz", type=int, default=5000, help="casos aleatorios")
+    parser.add_argument("--semilla", type=int, default=1234)
+    parser.add_argument("--tamano", type=int, default=100_000, help="bytes de la respuesta del benchmark")
+    parser.add_argument("--fragmento", type=int, default=20, help="caracteres por delta en el stream")
+    parser.add_argument("--repeticiones", type=int, default=20)
+    parser.add_argument("--salida", help="escribe el resultado en este JSON")
+    args = parser.parse_args()
+
+    rng = random.Random(args.semilla)
+    fallos = ejecutar_corpus(rng) + ejecutar_fuzz(rng, args.fuzz)
+    for texto, motivo in fallos[:20]:
+        print(f"FALLO: {motivo}: {texto!r}", file=sys.stderr)
+
+    resultado = {
+        "corpus": len(CORPUS) + len(INALTERADOS),
+        "fuzz": args.fuzz,
+        "fallos": len(fallos),
+        "benchmark": benchmark(rng, args.tamano, args.repeticiones, args.fragmento),
+    }
+    print(json.dumps(resultado, indent=2, ensure_ascii=False))
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+    sys.exit(1 if fallos else 0)
+
+
+if __name__ == "__main__":
+    main()
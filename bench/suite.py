@@ -0,0 +1,424 @@
+"""Suite de benchmarks de extremo a extremo contra un OpenAI simulado, sin red.
+
+Uso:
+    python bench/suite.py --salida bench/resultados.json
+    python bench/suite.py --servidor flask --concurrencia 1,5 --peticiones 50 --usuarios 20 --mensajes 200
+    DATABASE_URL=postgresql://... python bench/suite.py --escenarios chat_memoria,export
+
+Levanta bench/openai_simulado.py en un hilo, siembra (una sola vez) usuarios con
+historial y puntos clave, arranca la aplicación con gunicorn (o el servidor de
+desarrollo de Flask con --servidor flask) apuntando OPENAI_BASE_URL al simulado, y
+ejecuta cada escenario con cada nivel de --concurrencia. El resultado es un JSON
+con p50/p95/p99, throughput, errores y RSS pico del servidor por escenario, pensado
+para compararlo entre commits:
+
+    python bench/suite.py --salida antes.json && git checkout otra-rama && \\
+    python bench/suite.py --salida despues.json && diff antes.json despues.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.cookiejar import CookieJar
+from io import BytesIO
+from types import SimpleNamespace
+
+RAIZ = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, RAIZ)
+
+from openai_simulado import crear_servidor  # noqa: E402
+
+PASSWORD = "bench-password"
+LOTE = 20_000
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+##############################################
+# Siembra de datos                           #
+##############################################
+
+def sembrar(usuarios, mensajes):
+    """Crea benchN (memoria desactivada) y benchmemN (memoria activada) con historial."""
+    from sqlalchemy import insert, text
+    from werkzeug.security import generate_password_hash
+
+    from app import app, db, User, Message
+
+    with app.app_context():
+        db.create_all()
+        if User.query.filter_by(username="bench1").first() is not None:
+            return
+        # Un solo hash para todos: el costo de hashear no es lo que se mide aquí
+        hash_password = generate_password_hash(PASSWORD)
+        db.session.execute(insert(User), [
+            {"username": f"{prefijo}{i}", "password": hash_password, "memory_mode": memoria}
+            for prefijo, memoria in (("bench", False), ("benchmem", True))
+            for i in range(1, usuarios + 1)
+        ])
+        db.session.commit()
+
+        ids = [fila[0] for fila in db.session.query(User.id).filter(User.username.like("bench%"))]
+        inicio = datetime(2025, 1, 1)
+        filas = (
+            {
+                "user_id": user_id,
+                "role": "user" if n % 2 == 0 else "assistant",
+                "content": (
+                    f"Respuesta de prueba {n}.\n### Punto clave\nConcepto {n} del alumno."
+                    if n % 10 == 1 else f"Pregunta o respuesta de prueba número {n} sobre circuitos."
+                ),
+                "timestamp": inicio + timedelta(seconds=n),
+            }
+            for user_id in ids
+            for n in range(mensajes)
+        )
+        lote = []
+        for fila in filas:
+            lote.append(fila)
+            if len(lote) == LOTE:
+                db.session.execute(insert(Message), lote)
+                db.session.commit()
+                lote = []
+        if lote:
+            db.session.execute(insert(Message), lote)
+        db.session.execute(text(
+            "INSERT INTO key_point (user_id, message_id, content, timestamp) "
+            "SELECT user_id, id, content, timestamp FROM message "
+            "WHERE role = 'assistant' AND content LIKE '%### Punto clave%'"
+        ))
+        db.session.commit()
+        print(f"sembrados {len(ids)} usuarios y {len(ids) * mensajes} mensajes", file=sys.stderr)
+
+
+def documento_pdf(paginas):
+    from app import _exportar_pdf
+
+    nonce = uuid.uuid4().hex  # Contenido único: evita la deduplicación por SHA-256
+    filas = [
+        SimpleNamespace(role="user", timestamp=nonce, content=f"Página {p} " + "Texto de apuntes sobre circuitos. " * 150)
+        for p in range(paginas)
+    ]
+    return b"".join(_exportar_pdf(filas))
+
+
+def documento_docx(parrafos):
+    from docx import Document
+
+    documento = Document()
+    documento.add_paragraph(uuid.uuid4().hex)
+    for p in range(parrafos):
+        documento.add_paragraph(f"Párrafo {p}: " + "Texto de apuntes sobre circuitos. " * 20)
+    salida = BytesIO()
+    documento.save(salida)
+    return salida.getvalue()
+
+
+##############################################
+# Servidor y medición de memoria             #
+##############################################
+
+def arrancar_servidor(tipo, puerto, entorno):
+    if tipo == "gunicorn":
+        comando = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+                   "-b", f"127.0.0.1:{puerto}", "app:app"]
+    else:
+        comando = [sys.executable, "-m", "flask", "--app", "app", "run",
+                   "--port", str(puerto), "--with-threads"]
+    proceso = subprocess.Popen(comando, cwd=RAIZ, env=entorno,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    limite = time.monotonic() + 60
+    while time.monotonic() < limite:
+        if proceso.poll() is not None:
+            raise SystemExit(f"El servidor terminó al arrancar (código {proceso.returncode})")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{puerto}/login", timeout=2).read()
+            return proceso
+        except OSError:
+            time.sleep(0.25)
+    proceso.terminate()
+    raise SystemExit("El servidor no respondió en 60 s")
+
+
+def rss_arbol(pid):
+    """RSS en bytes del proceso y sus descendientes (workers de gunicorn), vía /proc."""
+    hijos, rss = {}, {}
+    for entrada in os.listdir("/proc"):
+        if not entrada.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entrada}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            with open(f"/proc/{entrada}/status") as f:
+                linea = next(l for l in f if l.startswith("VmRSS:"))
+        except (OSError, StopIteration, ValueError):
+            continue
+        hijos.setdefault(ppid, []).append(int(entrada))
+        rss[int(entrada)] = int(linea.split()[1]) * 1024
+    total, pendientes = 0, [pid]
+    while pendientes:
+        actual = pendientes.pop()
+        total += rss.get(actual, 0)
+        pendientes.extend(hijos.get(actual, []))
+    return total
+
+
+class MuestreoRSS(threading.Thread):
+    def __init__(self, pid, intervalo=0.2):
+        super().__init__(daemon=True)
+        self.pid, self.intervalo = pid, intervalo
+        self.pico = self.pico_total = 0
+        self.activo = os.path.isdir("/proc")
+        self.detener = threading.Event()
+
+    def reiniciar(self):
+        self.pico = 0
+
+    def run(self):
+        while self.activo and not self.detener.wait(self.intervalo):
+            rss = rss_arbol(self.pid)
+            self.pico = max(self.pico, rss)
+            self.pico_total = max(self.pico_total, rss)
+
+
+##############################################
+# Cliente HTTP y escenarios                  #
+##############################################
+
+class Cliente:
+    def __init__(self, url, usuario):
+        self.url, self.usuario = url, usuario
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+
+    def login(self):
+        datos = urllib.parse.urlencode({"username": self.usuario, "password": PASSWORD}).encode()
+        with self.opener.open(f"{self.url}/login", datos, timeout=300) as respuesta:
+            respuesta.read()
+            # Si las credenciales fallan, /login responde 200 en lugar de redirigir al chat
+            if urllib.parse.urlparse(respuesta.url).path == "/login":
+                raise RuntimeError(f"login rechazado para {self.usuario}")
+        return self
+
+    def abrir(self, ruta, cuerpo=None, cabeceras=None):
+        peticion = urllib.request.Request(f"{self.url}{ruta}", cuerpo, cabeceras or {})
+        return self.opener.open(peticion, timeout=300)
+
+    def json(self, ruta, datos):
+        with self.abrir(ruta, json.dumps(datos).encode(), {"Content-Type": "application/json"}) as respuesta:
+            return json.loads(respuesta.read())
+
+    def subir(self, nombre, contenido):
+        limite = uuid.uuid4().hex
+        cuerpo = (
+            f"--{limite}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{nombre}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode() + contenido + f"\r\n--{limite}--\r\n".encode()
+        with self.abrir("/upload", cuerpo, {"Content-Type": f"multipart/form-data; boundary={limite}"}) as respuesta:
+            trabajo = json.loads(respuesta.read())
+        while trabajo["status"] not in ("listo", "error"):
+            time.sleep(0.1)
+            with self.abrir(f"/upload/{trabajo['job_id']}") as respuesta:
+                trabajo = json.loads(respuesta.read())
+        if trabajo["status"] == "error":
+            raise RuntimeError(trabajo.get("error"))
+
+
+def escenario_login(cliente, _):
+    Cliente(cliente.url, cliente.usuario).login()
+
+
+def escenario_chat(cliente, i):
+    cliente.json("/chat", {"message": f"Explícame la ley de Ohm ({i})"})
+
+
+def escenario_chat_stream(cliente, i):
+    with cliente.abrir("/chat", json.dumps({"message": f"Explícame la ley de Ohm ({i})", "stream": True}).encode(),
+                       {"Content-Type": "application/json"}) as respuesta:
+        inicio = time.perf_counter()
+        respuesta.read(1)
+        primer_byte = time.perf_counter() - inicio
+        if b"event: error" in respuesta.read():
+            raise RuntimeError("el stream terminó con error")
+    return primer_byte
+
+
+def escenario_upload_pdf(cliente, _, paginas=10):
+    cliente.subir("apuntes.pdf", documento_pdf(paginas))
+
+
+def escenario_upload_docx(cliente, _, parrafos=200):
+    cliente.subir("apuntes.docx", documento_docx(parrafos))
+
+
+def escenario_export(cliente, _):
+    with cliente.abrir("/export?formato=txt") as respuesta:
+        while respuesta.read(65536):
+            pass
+
+
+def escenario_resumen(cliente, _):
+    with cliente.abrir("/resumen?limit=50") as respuesta:
+        respuesta.read()
+
+
+# nombre -> (función, prefijo de usuario: determina si la memoria está activada)
+ESCENARIOS = {
+    "login": (escenario_login, "bench"),
+    "chat_sin_memoria": (escenario_chat, "bench"),
+    "chat_memoria": (escenario_chat, "benchmem"),
+    "chat_stream": (escenario_chat_stream, "benchmem"),
+    "upload_pdf": (escenario_upload_pdf, "bench"),
+    "upload_docx": (escenario_upload_docx, "bench"),
+    "export": (escenario_export, "bench"),
+    "resumen": (escenario_resumen, "bench"),
+}
+
+
+def ejecutar(nombre, url, concurrencia, peticiones, usuarios, muestreo):
+    funcion, prefijo = ESCENARIOS[nombre]
+    with ThreadPoolExecutor(concurrencia) as pool:
+        clientes = list(pool.map(
+            lambda w: Cliente(url, f"{prefijo}{w % usuarios + 1}").login(), range(concurrencia)
+        ))
+
+        def medir(i):
+            inicio = time.perf_counter()
+            try:
+                extra = funcion(clientes[i % concurrencia], i)
+            except (OSError, RuntimeError, ValueError) as e:
+                return None, None, str(e)
+            return time.perf_counter() - inicio, extra, None
+
+        muestreo.reiniciar()
+        inicio = time.perf_counter()
+        mediciones = list(pool.map(medir, range(peticiones)))
+        duracion = time.perf_counter() - inicio
+
+    latencias = [m[0] for m in mediciones if m[0] is not None]
+    errores = [m[2] for m in mediciones if m[2] is not None]
+    resultado = {
+        "escenario": nombre,
+        "concurrencia": concurrencia,
+        "peticiones": peticiones,
+        "errores": len(errores),
+        "duracion_s": round(duracion, 3),
+        "throughput_rps": round(len(latencias) / duracion, 2),
+    }
+    if latencias:
+        resultado.update({
+            "p50_ms": round(statistics.median(latencias) * 1000, 1),
+            "p95_ms": round(percentil(latencias, 95) * 1000, 1),
+            "p99_ms": round(percentil(latencias, 99) * 1000, 1),
+        })
+    primeros = [m[1] for m in mediciones if m[1] is not None]
+    if primeros:
+        resultado["primer_byte_p50_ms"] = round(statistics.median(primeros) * 1000, 1)
+        resultado["primer_byte_p95_ms"] = round(percentil(primeros, 95) * 1000, 1)
+    resultado["rss_pico_mb"] = round(muestreo.pico / 2**20, 1) if muestreo.activo else None
+    if errores:
+        resultado["primer_error"] = errores[0]
+    return resultado
+
+
+def commit_actual():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--servidor", choices=("gunicorn", "flask"), default="gunicorn")
+    parser.add_argument("--puerto", type=int, default=8050)
+    parser.add_argument("--puerto-openai", type=int, default=8099)
+    parser.add_argument("--escenarios", default=",".join(ESCENARIOS))
+    parser.add_argument("--concurrencia", default="1,10,50", help="niveles separados por comas")
+    parser.add_argument("--peticiones", type=int, default=200, help="peticiones por escenario y nivel")
+    parser.add_argument("--usuarios", type=int, default=200, help="usuarios sembrados por modo de memoria")
+    parser.add_argument("--mensajes", type=int, default=500, help="mensajes sembrados por usuario")
+    parser.add_argument("--latencia", type=float, default=0.3, help="segundos hasta el primer token del simulado")
+    parser.add_argument("--tokens-por-segundo", type=float, default=80.0)
+    parser.add_argument("--tokens-salida", type=int, default=200)
+    parser.add_argument("--salida", default=os.path.join(RAIZ, "bench", "resultados.json"))
+    args = parser.parse_args()
+
+    escenarios = [e for e in args.escenarios.split(",") if e]
+    desconocidos = set(escenarios) - set(ESCENARIOS)
+    if desconocidos:
+        parser.error(f"escenarios desconocidos: {', '.join(sorted(desconocidos))}")
+    niveles = [int(n) for n in args.concurrencia.split(",")]
+
+    directorio = tempfile.mkdtemp(prefix="profai-bench-")
+    entorno = dict(
+        os.environ,
+        OPENAI_BASE_URL=f"http://127.0.0.1:{args.puerto_openai}/v1",
+        OPENAI_API_KEY="simulado",
+        UPLOAD_SPOOL_DIR=os.path.join(directorio, "subidas"),
+        LOG_METRICAS="0",
+    )
+    # Todo el tráfico sale de 127.0.0.1: el límite de intentos por IP cortaría los logins
+    entorno.setdefault("LIMITES_DB", "")
+    entorno.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(RAIZ, 'instance', 'bench.db')}")
+    os.makedirs(os.path.join(RAIZ, "instance"), exist_ok=True)
+    os.environ.update(entorno)
+
+    sembrar(args.usuarios, args.mensajes)
+
+    simulado = crear_servidor(args.puerto_openai, args.latencia, args.tokens_por_segundo, args.tokens_salida)
+    threading.Thread(target=simulado.serve_forever, daemon=True).start()
+
+    servidor = arrancar_servidor(args.servidor, args.puerto, entorno)
+    muestreo = MuestreoRSS(servidor.pid)
+    muestreo.start()
+    url = f"http://127.0.0.1:{args.puerto}"
+    resultados = []
+    try:
+        for nombre in escenarios:
+            for concurrencia in niveles:
+                resultado = ejecutar(nombre, url, concurrencia, args.peticiones, args.usuarios, muestreo)
+                resultados.append(resultado)
+                print(f"{nombre:<18} c={concurrencia:<4} p50={resultado.get('p50_ms')} ms "
+                      f"p95={resultado.get('p95_ms')} ms p99={resultado.get('p99_ms')} ms "
+                      f"{resultado['throughput_rps']} req/s errores={resultado['errores']}", file=sys.stderr)
+    finally:
+        muestreo.detener.set()
+        servidor.terminate()
+        servidor.wait(timeout=30)
+        simulado.shutdown()
+
+    with open(args.salida, "w", encoding="utf-8") as f:
+        json.dump({
+            "commit": commit_actual(),
+            "fecha": datetime.now().isoformat(timespec="seconds"),
+            "configuracion": {
+                "servidor": args.servidor,
+                "base_de_datos": entorno["DATABASE_URL"].split(":", 1)[0],
+                "usuarios": args.usuarios,
+                "mensajes_por_usuario": args.mensajes,
+                "latencia_openai_s": args.latencia,
+                "tokens_por_segundo": args.tokens_por_segundo,
+                "tokens_salida": args.tokens_salida,
+            },
+            "rss_pico_mb": round(muestreo.pico_total / 2**20, 1) if muestreo.activo else None,
+            "resultados": resultados,
+        }, f, indent=2, ensure_ascii=False)
+    print(f"resultados en {args.salida}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# Configuración de Gunicorn (se carga automáticamente con `gunicorn app:app`).
+#
+# Por defecto usa workers gevent: cada /chat espera a OpenAI en una greenlet, así
+# que un mismo proceso atiende muchas conversaciones en paralelo sin bloquear
+# /login ni /export. Con GUNICORN_WORKER_CLASS=sync se vuelve al modelo anterior
+# (útil para comparar con bench/carga_chat.py).
+import os
+import subprocess
+import sys
+
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gevent")
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+
+# Las respuestas en streaming pueden durar varios minutos
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 300))
+keepalive = 5
+
+
+def post_fork(server, worker):
+    # psycopg2 no coopera con gevent por sí solo; psycogreen hace que las consultas
+    # a Postgres cedan el control mientras esperan la red.
+    if worker_class == "gevent":
+        try:
+            from psycogreen.gevent import patch_psycopg
+        except ImportError:
+            server.log.warning("psycogreen no está instalado; las consultas a Postgres bloquearán el worker")
+        else:
+            patch_psycopg()
+
+
+def child_exit(server, worker):
+    # Limpia las métricas del worker que terminó (modo multiproceso de prometheus_client)
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def on_starting(server):
+    # La app reparte OPENAI_TPM entre WEB_CONCURRENCY workers: se fija al valor real
+    # (incluido un -w por línea de comandos) antes de que los workers la carguen
+    os.environ["WEB_CONCURRENCY"] = str(server.cfg.workers)
+
+    # MathJax y Font Awesome se sirven desde static/vendor: si el build no corrió
+    # `flask descargar-recursos`, se descargan aquí una vez (el comando se salta lo que
+    # ya está). En un proceso aparte, para no cargar la app en el master antes del fork.
+    if os.environ.get("DESCARGAR_RECURSOS", "1") == "1":
+        try:
+            subprocess.run(
+                [sys.executable, "-m", "flask", "--app", "app", "descargar-recursos"],
+                cwd=os.path.dirname(os.path.abspath(__file__)), check=True, timeout=600
+            )
+        except (subprocess.SubprocessError, OSError) as e:
+            server.log.warning(f"No se pudieron descargar los recursos estáticos ({e}); se usará el CDN")
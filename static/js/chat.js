@@ -0,0 +1,442 @@
+let isDarkMode = false;
+// memoriaActiva se inicializa en index.html con el valor inyectado desde el backend.
+
+document.addEventListener("DOMContentLoaded", function(){
+  document.getElementById('memory-btn').innerHTML = `<i class="fas fa-brain"></i> Memoria: ${memoriaActiva ? 'ON' : 'OFF'}`;
+  updateChatPosition();
+  iniciarHistorial();
+});
+
+function processContent(text) {
+  return text
+    .replace(/^##### (.*$)/gm, '<h5>$1</h5>')
+    .replace(/^#### (.*$)/gm, '<h4>$1</h4>')
+    .replace(/^### (.*$)/gm, '<h3>$1</h3>')
+    .replace(/^## (.*$)/gm, '<h2>$1</h2>')
+    .replace(/^# (.*$)/gm, '<h1>$1</h1>')
+    .replace(/\*\*(.*?)\*\*/g, '<strong>$1</strong>')
+    .replace(/\*(.*?)\*/g, '<em>$1</em>')
+    .replace(/```([\s\S]*?)```/g, '<pre><code>$1</code></pre>')
+    .replace(/!\[(.*?)\]\((.*?)\)/g, '<img src="$2" alt="$1" class="card">')
+    .replace(/\$\$(.*?)\$\$/gs, '\\[$1\\]')
+    .replace(/\$(.*?)\$/g, '\\($1\\)')
+    .replace(/\n/g, '<br>')
+    .replace(/^\d+\.\s+(.*$)/gm, '<ol><li>$1</li></ol>')
+    .replace(/<\/ol>\n<ol>/g, '');
+}
+
+// MathJax (~1 MB) solo se descarga la primera vez que un mensaje trae LaTeX
+const LATEX = /\$|\\[(\[]|\\begin\{/;
+let cargaMathJax = null;
+let colaTipografia = Promise.resolve();
+
+function cargarMathJax() {
+  if (!cargaMathJax) {
+    window.MathJax = {
+      tex: {
+        inlineMath: [['\\(', '\\)'], ['$', '$']],
+        displayMath: [['\\[', '\\]'], ['$$', '$$']],
+        processEscapes: true
+      },
+      options: {
+        skipHtmlTags: ['script', 'noscript', 'style', 'textarea', 'pre'],
+        ignoreHtmlClass: 'tex-ignore'
+      },
+      // Se tipografía mensaje por mensaje, nunca la página completa
+      startup: { typeset: false }
+    };
+    cargaMathJax = new Promise((resolve, reject) => {
+      const script = document.createElement('script');
+      script.src = document.body.dataset.mathjax;
+      script.async = true;
+      script.onload = () => MathJax.startup.promise.then(resolve, reject);
+      script.onerror = reject;
+      document.head.appendChild(script);
+    });
+  }
+  return cargaMathJax;
+}
+
+// Tipografía solo los elementos con LaTeX; las llamadas se encadenan porque
+// MathJax no admite varios typesetPromise simultáneos.
+function typeset(elementos) {
+  const conLatex = elementos.filter(el => LATEX.test(el.textContent));
+  if (!conLatex.length) return colaTipografia;
+  colaTipografia = colaTipografia
+    .then(cargarMathJax)
+    .then(() => MathJax.typesetPromise(conLatex))
+    .catch(error => console.error('Error de MathJax:', error));
+  return colaTipografia;
+}
+
+function contar(texto, marca) {
+  return texto.split(marca).length - 1;
+}
+
+// Mensaje que llega por partes. Los bloques ya cerrados (terminados en una línea en
+// blanco fuera de ``` y $$) se pintan y tipografían una sola vez; con cada fragmento
+// solo se vuelve a pintar el bloque en curso.
+class MensajeEnCurso {
+  constructor(chatBox) {
+    this.chatBox = chatBox;
+    this.el = createMessageElement('', false);
+    this.cola = document.createElement('span');
+    this.el.appendChild(this.cola);
+    chatBox.appendChild(this.el);
+    this.texto = '';
+    this.fijado = 0;
+  }
+
+  agregar(fragmento) {
+    this.texto += fragmento;
+    const corte = this.finDeBloques();
+    if (corte > this.fijado) {
+      const bloque = document.createElement('span');
+      bloque.innerHTML = processContent(this.texto.slice(this.fijado, corte));
+      this.el.insertBefore(bloque, this.cola);
+      this.fijado = corte;
+      typeset([bloque]).then(() => this.desplazar());
+    }
+    this.cola.innerHTML = processContent(this.texto.slice(this.fijado));
+    this.desplazar();
+  }
+
+  finDeBloques() {
+    let corte = this.fijado;
+    for (let i = this.texto.indexOf('\n\n', this.fijado); i !== -1; i = this.texto.indexOf('\n\n', i + 2)) {
+      const pendiente = this.texto.slice(this.fijado, i);
+      if (contar(pendiente, '```') % 2 === 0 && contar(pendiente, '$$') % 2 === 0) corte = i + 2;
+    }
+    return corte;
+  }
+
+  desplazar() {
+    this.chatBox.scrollTop = this.chatBox.scrollHeight;
+  }
+
+  async terminar() {
+    await typeset([this.cola]);
+    this.desplazar();
+  }
+}
+
+// Historial paginado: /history se pide de a una página y las anteriores se cargan al
+// acercarse al principio del chat. Los mensajes que quedan lejos de la vista se
+// vacían (conservando su tamaño) y se vuelven a pintar al acercarse, así el DOM y el
+// trabajo de MathJax no crecen con la longitud del historial.
+const HISTORIAL_PAGINA = 50;
+const MARGEN_CARGA = 300;  // px desde el borde superior para pedir la página anterior
+let historialAntes;        // Cursor de /history: undefined al inicio, null si no quedan mensajes
+let cargandoHistorial = false;
+let observadorMensajes;
+
+function iniciarHistorial() {
+  const chatBox = document.getElementById('chat-box');
+  observadorMensajes = new IntersectionObserver(alternarMensajes, { root: chatBox, rootMargin: '1500px 0px' });
+  chatBox.addEventListener('scroll', () => {
+    if (chatBox.scrollTop < MARGEN_CARGA) cargarHistorial();
+  });
+  cargarHistorial();
+}
+
+function alternarMensajes(entradas) {
+  for (const { target, isIntersecting } of entradas) {
+    if (isIntersecting && target.dataset.vacio) {
+      target.innerHTML = processContent(target.contenido);
+      target.style.width = target.style.height = '';
+      delete target.dataset.vacio;
+      typeset([target]);
+    } else if (!isIntersecting && !target.dataset.vacio) {
+      target.style.width = `${target.offsetWidth}px`;
+      target.style.height = `${target.offsetHeight}px`;
+      if (window.MathJax && MathJax.typesetClear) MathJax.typesetClear([target]);
+      target.innerHTML = '';
+      target.dataset.vacio = '1';
+    }
+  }
+}
+
+async function cargarHistorial() {
+  if (cargandoHistorial || historialAntes === null) return;
+  cargandoHistorial = true;
+  try {
+    const params = new URLSearchParams({ limit: HISTORIAL_PAGINA });
+    if (historialAntes) params.set('before', historialAntes);
+    const response = await fetch(`/history?${params}`);
+    if (!response.ok) throw new Error(`HTTP ${response.status}`);
+    const data = await response.json();
+
+    const chatBox = document.getElementById('chat-box');
+    const pagina = data.messages.map(m => {
+      const el = createMessageElement(m.content, m.role === 'user');
+      el.contenido = m.content;
+      return el;
+    });
+    // Se antepone la página sin mover lo que el alumno está viendo
+    const altoPrevio = chatBox.scrollHeight;
+    chatBox.prepend(...pagina);
+    chatBox.scrollTop += chatBox.scrollHeight - altoPrevio;
+    pagina.forEach(el => observadorMensajes.observe(el));
+    typeset(pagina);
+    historialAntes = data.next_before;
+  } catch (error) {
+    console.error('Error cargando el historial:', error);
+    return;
+  } finally {
+    cargandoHistorial = false;
+  }
+  // Si la página no llena el chat no habrá scroll que pida la siguiente
+  if (document.getElementById('chat-box').scrollTop < MARGEN_CARGA) cargarHistorial();
+}
+
+function updateChatPosition() {
+  const sidebar = document.getElementById('sidebar');
+  const chatContainer = document.getElementById('chatContainer');
+  
+  if (window.innerWidth > 600) {
+    if (sidebar.classList.contains('collapsed')) {
+      chatContainer.style.marginLeft = "auto";
+      chatContainer.style.marginRight = "auto";
+    } else {
+      chatContainer.style.marginLeft = "calc(50% - 300px)";
+      chatContainer.style.marginRight = "";
+    }
+  } else {
+    chatContainer.style.margin = "0 auto";
+  }
+}
+
+function toggleSidebar() {
+  const sidebar = document.getElementById('sidebar');
+  if(window.innerWidth <= 600) {
+    sidebar.classList.toggle('active');
+  } else {
+    sidebar.classList.toggle('collapsed');
+    updateChatPosition();
+  }
+}
+
+function createMessageElement(content, isUser) {
+  const div = document.createElement('div');
+  div.className = `message ${isUser ? 'user-message' : 'bot-message'}`;
+  div.innerHTML = processContent(content);
+  return div;
+}
+
+async function sendMessage() {
+  const input = document.getElementById('user-input');
+  const message = input.value.trim();
+  if (!message) return;
+
+  const chatBox = document.getElementById('chat-box');
+  chatBox.appendChild(createMessageElement(message, true));
+  input.value = '';
+  
+  showLoading(true);
+  
+  try {
+    await streamChat(message);
+  } catch(error) {
+    chatBox.appendChild(createMessageElement(`Error: ${error.message}`, false));
+  }
+  
+  showLoading(false);
+}
+
+// Envía un mensaje a /chat en modo streaming y va pintando la respuesta a medida que llega
+async function streamChat(message) {
+  const chatBox = document.getElementById('chat-box');
+  const response = await fetch('/chat', {
+    method: 'POST',
+    headers: {'Content-Type': 'application/json'},
+    body: JSON.stringify({message, stream: true})
+  });
+
+  const contentType = response.headers.get('Content-Type') || '';
+  if (!contentType.startsWith('text/event-stream')) {
+    // Respuestas inmediatas (p. ej. /clear o errores de validación) siguen llegando como JSON
+    const data = await response.json();
+    const newMessage = createMessageElement(data.response, false);
+    chatBox.appendChild(newMessage);
+    await typeset([newMessage]);
+    chatBox.scrollTop = chatBox.scrollHeight;
+    return;
+  }
+
+  const mensaje = new MensajeEnCurso(chatBox);
+  showLoading(false);
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    const events = buffer.split('\n\n');
+    buffer = events.pop();
+    for (const event of events) {
+      const dataLine = event.split('\n').find(line => line.startsWith('data: '));
+      if (!dataLine) continue;
+      const data = JSON.parse(dataLine.slice(6));
+      if (event.startsWith('event: error')) {
+        mensaje.agregar(`\n\n${data.response}`);
+      } else if (data.delta) {
+        mensaje.agregar(data.delta);
+      }
+    }
+  }
+
+  await mensaje.terminar();
+}
+
+function showLoading(show) {
+  const typingIndicator = document.getElementById('typing');
+  typingIndicator.style.display = show ? 'block' : 'none';
+}
+
+function toggleDarkMode() {
+  isDarkMode = !isDarkMode;
+  document.body.classList.toggle('dark-mode');
+  document.querySelector('.dark-mode-toggle i').className = 
+      isDarkMode ? 'fas fa-sun' : 'fas fa-moon';
+}
+
+function handleKeyPress(e) {
+  if (e.key === 'Enter' && !e.shiftKey) {
+    e.preventDefault();
+    sendMessage();
+  }
+}
+
+function toggleMemoria() {
+  fetch('/toggle_memoria', { method: 'POST' })
+    .then(response => response.json())
+    .then(data => {
+      if (data.status === "success") {
+        memoriaActiva = data.memory_mode;
+        document.getElementById('memory-btn').innerHTML = `<i class="fas fa-brain"></i> Memoria: ${memoriaActiva ? 'ON' : 'OFF'}`;
+      } else {
+        alert('Error al actualizar el estado de memoria');
+      }
+    })
+    .catch(error => {
+      console.error('Error actualizando memoria:', error);
+      alert('Error actualizando memoria');
+    });
+}
+
+function exportChat(formato = 'txt') {
+  // El servidor genera la exportación del historial completo en streaming (txt, md, jsonl o pdf)
+  const a = document.createElement('a');
+  a.href = `/export?formato=${formato}`;
+  a.click();
+}
+
+function showHelp() {
+  const helpContent = `
+      ## 🆘 Centro de Ayuda
+      **Comandos disponibles:**
+      - \`/clear\` - Reiniciar conversación
+      - \`/example [tema]\` - Solicitar ejemplos
+      - \`/exercise\` - Generar ejercicio práctico
+      - \`/summary\` - Resumen del tema
+      - \`/help\` - Mostrar esta ayuda
+
+      **Funcionalidades:**
+      - Modo oscuro (icono luna)
+      - Exportar conversación
+      - Memoria contextual (activar/desactivar)
+  `;
+  
+  const chatBox = document.getElementById('chat-box');
+  chatBox.appendChild(createMessageElement(helpContent, false));
+  chatBox.scrollTop = chatBox.scrollHeight;
+}
+
+function toggleCourse(courseId) {
+  const topics = document.getElementById(`${courseId}-topics`);
+  topics.style.display = topics.style.display === 'none' || topics.style.display === '' ? 'block' : 'none';
+}
+
+function sendTopicPrompt(topic) {
+  const prompt = `/explicar Por favor explica el tema "${topic}" de manera detallada:
+Te daré libertad para explicar los temas de acuerdo al perfil de cada alumno,
+personaliza la explicación, define en qué profundidad explicas los temas, qué recursos usas, etc.
+Me gustaría que hagas preguntas conceptuales desafiantes y propongas ejercicios interesantes.
+Un punto importante es que cada vez que hagas una pregunta conceptual, esperes la respuesta antes de continuar tu explicación.
+Permite que la conversación se ramifique a partir de la respuesta y usa estas para aprender del alumno.`;
+
+  showLoading(true);
+  
+  streamChat(prompt)
+  .catch(error => {
+    console.error('Error:', error);
+    const chatBox = document.getElementById('chat-box');
+    chatBox.appendChild(createMessageElement("⚠️ Error al cargar el tema", false));
+  })
+  .finally(() => showLoading(false));
+}
+
+const ESPERA_SUBIDA_MAX_MS = 15 * 60 * 1000;  // Tope del sondeo de /upload/<job_id>
+
+async function uploadFile() {
+const input = document.getElementById('file-input');
+if (input.files.length === 0) return;
+
+const file = input.files[0];
+const formData = new FormData();
+formData.append('file', file);
+
+showLoading(true); // Mostrar indicador de carga
+
+try {
+const response = await fetch('/upload', {
+  method: 'POST',
+  body: formData
+});
+
+let data = await response.json();
+if (response.ok) {
+  // El archivo se procesa en segundo plano: se consulta el estado hasta que termine
+  const typing = document.getElementById('typing');
+  const limite = Date.now() + ESPERA_SUBIDA_MAX_MS;
+  while (data.status === 'pendiente' || data.status === 'procesando') {
+    if (Date.now() > limite) {
+      data = { status: 'error', error: 'El archivo está tardando demasiado en procesarse. Inténtalo de nuevo más tarde.' };
+      break;
+    }
+    if (data.pages_total) {
+      typing.innerHTML = `<i class="fas fa-circle-notch fa-spin"></i> Procesando archivo... ${data.pages_done}/${data.pages_total} páginas`;
+    }
+    await new Promise(resolve => setTimeout(resolve, 1000));
+    data = await (await fetch(`/upload/${data.job_id}`)).json();
+  }
+  typing.innerHTML = '<i class="fas fa-circle-notch fa-spin"></i> Pensando...';
+
+  if (data.status === 'listo') {
+    // En lugar de mostrar el contenido del archivo, solo se muestra un mensaje de confirmación.
+    const message = `Archivo "${file.name}" subido correctamente.`;
+    const chatBox = document.getElementById('chat-box');
+    chatBox.appendChild(createMessageElement(message, false));
+    chatBox.scrollTop = chatBox.scrollHeight;
+  } else {
+    alert(data.error || 'Error al subir el archivo.');
+  }
+} else {
+  alert(data.error || 'Error al subir el archivo.');
+}
+} catch (error) {
+console.error('Error al subir archivo:', error);
+alert('Error al subir el archivo.');
+} finally {
+showLoading(false);
+input.value = ''; // Reinicia el input para poder subir el mismo archivo de nuevo si se desea.
+}
+}
+
+
+document.addEventListener("DOMContentLoaded", updateChatPosition);
+window.addEventListener("resize", updateChatPosition);
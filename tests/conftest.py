@@ -0,0 +1,103 @@
+"""Fixtures comunes: base SQLite temporal, modelo simulado y clientes con sesión.
+
+La aplicación lee su configuración del entorno al importarse, así que el entorno
+de pruebas se fija antes del import. Ninguna prueba usa la red ni la API real:
+`completar_chat` se sustituye por `ModeloSimulado`.
+"""
+import os
+import tempfile
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+_DIRECTORIO = tempfile.mkdtemp(prefix="profai-tests-")
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{os.path.join(_DIRECTORIO, 'tests.db')}",
+    "LIMITES_DB": os.path.join(_DIRECTORIO, "limites.db"),
+    "UPLOAD_SPOOL_DIR": os.path.join(_DIRECTORIO, "subidas"),
+    "HASH_METODO": "pbkdf2:sha256:1000",  # Hashes rápidos: aquí no se mide su costo
+    "HASH_PROCESOS": "1",
+    "LOG_METRICAS": "0",
+    "LLM_CACHE": "0",
+    "ESCRITURA_DIFERIDA": "",
+    "USUARIO_EN_SESION": "0",
+    "OPENAI_API_KEY": "pruebas",
+})
+os.environ.pop("DATABASE_REPLICA_URL", None)
+os.environ.pop("METRICS_TOKEN", None)
+
+import app as aplicacion  # noqa: E402
+
+PASSWORD = "password123"
+
+
+class ModeloSimulado:
+    """Sustituye a `completar_chat`: responde `texto` y anota cada llamada.
+
+    Con `puerta` (un threading.Event) la llamada espera a que se abra antes de
+    responder; `llamada` se activa en cuanto entra la primera.
+    """
+
+    def __init__(self):
+        self.texto = "La ley de Ohm.\n### Punto clave\nV = I · R"
+        self.llamadas = []
+        self.puerta = None
+        self.llamada = threading.Event()
+
+    def __call__(self, mensajes, stream=False, user_id=None, **parametros):
+        self.llamadas.append(mensajes)
+        self.llamada.set()
+        if self.puerta is not None:
+            self.puerta.wait(5)
+        if stream:
+            return (
+                SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=self.texto[i:i + 7]))])
+                for i in range(0, len(self.texto), 7)
+            )
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=self.texto))],
+            usage=SimpleNamespace(prompt_tokens=10, completion_tokens=20)
+        )
+
+
+def entrar(cliente, usuario, password=PASSWORD):
+    cliente.post("/register", data={"username": usuario, "password": password})
+    respuesta = cliente.post("/login", data={"username": usuario, "password": password})
+    assert respuesta.status_code == 302, respuesta.status_code
+    return cliente
+
+
+@pytest.fixture(scope="session")
+def app():
+    with aplicacion.app.app_context():
+        aplicacion.db.create_all()
+    return aplicacion.app
+
+
+@pytest.fixture(autouse=True)
+def base(app, tmp_path):
+    """Cada prueba arranca con las tablas vacías y sin estado en memoria de las anteriores."""
+    with app.app_context():
+        for tabla in reversed(aplicacion.db.metadata.sorted_tables):
+            aplicacion.db.session.execute(tabla.delete())
+        aplicacion.db.session.commit()
+    # SQLite reutiliza ids: una caché vieja atribuiría datos a otro usuario
+    aplicacion._cache_usuarios._datos.clear()
+    aplicacion._cache_llm._datos.clear()
+    aplicacion._turnos_en_curso.clear()
+    aplicacion._limitador.ruta = str(tmp_path / "limites.db")
+    aplicacion._limitador._preparado = False
+    yield
+
+
+@pytest.fixture
+def modelo(monkeypatch):
+    simulado = ModeloSimulado()
+    monkeypatch.setattr(aplicacion, "completar_chat", simulado)
+    return simulado
+
+
+@pytest.fixture
+def cliente(app):
+    return entrar(app.test_client(), "alumno")
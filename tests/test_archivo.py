@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as aplicacion
+from app import ConversationSummary, KeyPoint, Message, MessageArchive, User, archivar_lote, db, mensajes_archivados
+
+VIEJO = datetime.utcnow() - timedelta(days=400)
+LIMITE = datetime.utcnow() - timedelta(days=180)
+
+
+def crear_usuario(nombre, memoria, mensajes):
+    user = User(username=nombre, password="x", memory_mode=memoria)
+    db.session.add(user)
+    db.session.flush()
+    filas = [
+        Message(user_id=user.id, role="assistant" if n % 2 else "user", content=f"{nombre} {n}",
+                timestamp=VIEJO + timedelta(minutes=n))
+        for n in range(mensajes)
+    ]
+    db.session.add_all(filas)
+    db.session.flush()
+    return user, [fila.id for fila in filas]
+
+
+def archivar_todo(lote=3):
+    total, desde = 0, 0
+    while True:
+        archivados, desde = archivar_lote(LIMITE, desde, lote)
+        if not archivados:
+            return total, desde
+        total += archivados
+
+
+def test_archivo_respeta_el_resumen_y_el_modo_memoria(app):
+    with app.app_context():
+        sin_memoria, _ = crear_usuario("sin_memoria", False, 4)
+        memoria_sin_resumen, _ = crear_usuario("memoria_sin_resumen", True, 4)
+        memoria_con_resumen, ids = crear_usuario("memoria_con_resumen", True, 4)
+        db.session.add(ConversationSummary(user_id=memoria_con_resumen.id, content="r", last_message_id=ids[1]))
+        db.session.commit()
+
+        total, _ = archivar_todo()
+
+        assert total == 4 + 2
+        quedan = {u.username: Message.query.filter_by(user_id=u.id).count()
+                  for u in (sin_memoria, memoria_sin_resumen, memoria_con_resumen)}
+        assert quedan == {"sin_memoria": 0, "memoria_sin_resumen": 4, "memoria_con_resumen": 2}
+
+
+def test_archivo_conserva_mensajes_y_puntos_clave(app):
+    with app.app_context():
+        user, ids = crear_usuario("alumno", False, 5)
+        db.session.add(KeyPoint(user_id=user.id, message_id=ids[1], content="punto", timestamp=VIEJO))
+        db.session.add(Message(user_id=user.id, role="user", content="reciente", timestamp=datetime.utcnow()))
+        db.session.commit()
+
+        total, ultimo = archivar_todo(lote=2)
+
+        assert total == 5 and ultimo == ids[-1]
+        assert archivar_lote(LIMITE, ultimo, 2) == (0, ultimo)  # La marca no retrocede
+        assert MessageArchive.query.count() == 3
+        assert [m.content for m in mensajes_archivados(user.id)] == [f"alumno {n}" for n in range(5)]
+        assert [m.content for m in Message.query.filter_by(user_id=user.id)] == ["reciente"]
+        assert KeyPoint.query.one().message_id is None
+
+
+def test_descomprimir_zstd_sin_zstandard_falla_con_un_error_claro(monkeypatch):
+    monkeypatch.setattr(aplicacion, "zstandard", None)
+    with pytest.raises(RuntimeError, match="zstandard"):
+        aplicacion.descomprimir("zstd", b"\x28\xb5\x2f\xfd")
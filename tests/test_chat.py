@@ -0,0 +1,103 @@
+import json
+import threading
+
+from app import Message, PlanificadorOpenAI, db, terminar_turno, unirse_a_turno
+
+from .conftest import entrar
+
+
+def deltas_sse(cuerpo):
+    return "".join(
+        json.loads(linea[len("data: "):]).get("delta", "")
+        for linea in cuerpo.splitlines() if linea.startswith("data: ")
+    )
+
+
+def test_chat_guarda_el_texto_crudo_y_sanitiza_la_respuesta(app, cliente, modelo):
+    modelo.texto = "Incluye <stdio.h> y <script>alert(1)</script>"
+
+    respuesta = cliente.post("/chat", json={"message": "hola"})
+
+    assert respuesta.status_code == 200
+    assert "<stdio.h>" not in respuesta.get_json()["response"]
+    assert "&lt;script>" in respuesta.get_json()["response"]
+    with app.app_context():
+        guardado = Message.query.filter_by(role="assistant").one()
+        assert guardado.content == modelo.texto
+
+
+def test_stream_entrega_lo_mismo_que_la_respuesta_completa(app, cliente, modelo):
+    modelo.texto = "Paso 1: <b>negrita</b> y ![x](javascript:alert(1)) fin " * 4
+
+    completa = cliente.post("/chat", json={"message": "uno"}).get_json()["response"]
+    stream = cliente.post("/chat", json={"message": "dos", "stream": True}).get_data(as_text=True)
+
+    assert deltas_sse(stream) == completa
+    with app.app_context():
+        assert [m.content for m in Message.query.filter_by(role="assistant")] == [modelo.texto] * 2
+
+
+def test_envio_duplicado_comparte_una_sola_llamada(app, modelo):
+    modelo.puerta = threading.Event()
+    primero = entrar(app.test_client(), "doble")
+    segundo = entrar(app.test_client(), "doble")
+    respuestas = {}
+
+    def enviar(nombre, cliente):
+        respuestas[nombre] = cliente.post("/chat", json={"message": "¿qué es un ohmio?"}).get_json()
+
+    hilo_primero = threading.Thread(target=enviar, args=("primero", primero))
+    hilo_primero.start()
+    assert modelo.llamada.wait(5)
+    hilo_segundo = threading.Thread(target=enviar, args=("segundo", segundo))
+    hilo_segundo.start()
+    modelo.puerta.set()
+    hilo_primero.join(10)
+    hilo_segundo.join(10)
+
+    assert len(modelo.llamadas) == 1
+    assert respuestas["primero"] == respuestas["segundo"]
+    with app.app_context():
+        assert db.session.query(Message).filter_by(role="user").count() == 1
+
+
+def test_unirse_a_turno_libera_la_clave_al_terminar():
+    turno, primero = unirse_a_turno(1, "hola")
+    repetido, segundo = unirse_a_turno(1, "hola")
+    assert primero and not segundo and repetido is turno
+
+    terminar_turno(turno, "respuesta")
+    assert repetido.result() == "respuesta"
+    assert unirse_a_turno(1, "hola")[1]
+
+
+def test_planificador_limita_las_llamadas_simultaneas_por_usuario():
+    planificador = PlanificadorOpenAI(por_usuario=1, globales=10, tpm=0, espera_max=5)
+    dentro = threading.Event()
+    soltar = threading.Event()
+    orden = []
+
+    def ocupar():
+        with planificador.turno("a", 10):
+            dentro.set()
+            soltar.wait(5)
+            orden.append("a1 sale")
+
+    def llamar(usuario, etiqueta):
+        with planificador.turno(usuario, 10):
+            orden.append(etiqueta)
+
+    primero = threading.Thread(target=ocupar)
+    primero.start()
+    assert dentro.wait(5)
+    mismo_usuario = threading.Thread(target=llamar, args=("a", "a2 entra"))
+    otro_usuario = threading.Thread(target=llamar, args=("b", "b entra"))
+    mismo_usuario.start()
+    otro_usuario.start()
+    otro_usuario.join(5)
+    assert orden == ["b entra"]  # `a` sigue esperando su cupo
+
+    soltar.set()
+    primero.join(5)
+    mismo_usuario.join(5)
+    assert orden == ["b entra", "a1 sale", "a2 entra"]
@@ -0,0 +1,37 @@
+from .conftest import PASSWORD, entrar
+
+
+def intentar(cliente, usuario, password):
+    return cliente.post("/login", data={"username": usuario, "password": password}).status_code
+
+
+def test_bloquea_al_usuario_tras_la_rafaga_de_fallos(app):
+    cliente = entrar(app.test_client(), "alumno")
+    rafaga = app.config["LOGIN_RAFAGA_USUARIO"]
+
+    fallos = [intentar(cliente, "alumno", "incorrecta") for _ in range(rafaga)]
+    bloqueado = cliente.post("/login", data={"username": "alumno", "password": PASSWORD})
+
+    assert fallos == [302] * rafaga
+    assert bloqueado.status_code == 429
+    assert int(bloqueado.headers["Retry-After"]) >= 1
+    # El bloqueo es por usuario: otro alumno desde la misma IP sigue entrando
+    entrar(app.test_client(), "otro")
+
+
+def test_los_logins_correctos_no_gastan_intentos(app):
+    cliente = entrar(app.test_client(), "alumno")
+
+    resultados = [intentar(cliente, "alumno", PASSWORD) for _ in range(app.config["LOGIN_RAFAGA_IP"] + 5)]
+
+    assert resultados == [302] * len(resultados)
+
+
+def test_bloquea_la_ip_tras_fallos_con_usuarios_distintos(app):
+    cliente = app.test_client()
+    rafaga = app.config["LOGIN_RAFAGA_IP"]
+
+    resultados = [intentar(cliente, f"inexistente{n}", "x") for n in range(rafaga + 1)]
+
+    assert resultados[:rafaga] == [302] * rafaga
+    assert resultados[-1] == 429
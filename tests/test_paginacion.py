@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta
+
+from app import KeyPoint, Message, User, db
+
+from .conftest import entrar
+
+
+def sembrar_mensajes(usuario, cantidad, mismo_instante=False):
+    user_id = User.query.filter_by(username=usuario).one().id
+    inicio = datetime(2025, 1, 1)
+    db.session.add_all(
+        Message(
+            user_id=user_id,
+            role="user" if n % 2 == 0 else "assistant",
+            content=f"mensaje {n}",
+            timestamp=inicio if mismo_instante else inicio + timedelta(minutes=n)
+        )
+        for n in range(cantidad)
+    )
+    db.session.commit()
+
+
+def paginas_historial(cliente, limite):
+    paginas, antes = [], None
+    while True:
+        consulta = f"/history?limit={limite}" + (f"&before={antes}" if antes else "")
+        datos = cliente.get(consulta).get_json()
+        paginas.append([m["content"] for m in datos["messages"]])
+        antes = datos["next_before"]
+        if antes is None:
+            return paginas
+
+
+def test_historial_recorre_todo_sin_repetir(app, cliente):
+    with app.app_context():
+        sembrar_mensajes("alumno", 7)
+
+    paginas = paginas_historial(cliente, 3)
+
+    assert paginas == [
+        ["mensaje 4", "mensaje 5", "mensaje 6"],
+        ["mensaje 1", "mensaje 2", "mensaje 3"],
+        ["mensaje 0"],
+    ]
+
+
+def test_historial_desempata_por_id_con_el_mismo_timestamp(app, cliente):
+    with app.app_context():
+        sembrar_mensajes("alumno", 5, mismo_instante=True)
+
+    vistos = [contenido for pagina in reversed(paginas_historial(cliente, 2)) for contenido in pagina]
+
+    assert vistos == [f"mensaje {n}" for n in range(5)]
+
+
+def test_historial_rechaza_limit_no_positivo(cliente):
+    assert cliente.get("/history?limit=0").status_code == 400
+
+
+def puntos_clave(app, usuario, cantidad):
+    with app.app_context():
+        user_id = User.query.filter_by(username=usuario).one().id
+        db.session.add_all(
+            KeyPoint(user_id=user_id, content=f"punto {n}", timestamp=datetime(2025, 1, 1) + timedelta(minutes=n))
+            for n in range(cantidad)
+        )
+        db.session.commit()
+
+
+def test_resumen_pagina_con_el_cursor_despues(app, cliente):
+    puntos_clave(app, "alumno", 5)
+
+    primera = cliente.get("/resumen?limit=2").get_json()
+    segunda = cliente.get(f"/resumen?limit=2&despues={primera['siguiente']}").get_json()
+    tercera = cliente.get(f"/resumen?limit=2&despues={segunda['siguiente']}").get_json()
+
+    assert "punto 0" in primera["response"] and "punto 1" in primera["response"]
+    assert "punto 2" in segunda["response"] and "punto 1" not in segunda["response"]
+    assert "punto 4" in tercera["response"] and tercera["siguiente"] is None
+
+
+def test_resumen_rechaza_cursores_desconocidos_o_ajenos(app, cliente):
+    otro = entrar(app.test_client(), "otro")
+    puntos_clave(app, "otro", 1)
+    with app.app_context():
+        ajeno = KeyPoint.query.one().id
+
+    for despues in ("999999", "abc", str(ajeno)):
+        assert cliente.get(f"/resumen?despues={despues}").status_code == 400
+    assert otro.get(f"/resumen?despues={ajeno}").status_code == 200
+    assert cliente.get("/resumen?limit=0").status_code == 400
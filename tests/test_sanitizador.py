@@ -0,0 +1,38 @@
+import random
+
+import pytest
+
+from app import sanitizar_markdown, sanitizar_stream
+from bench.sanitizador import CORPUS, INALTERADOS, PIEZAS_FUZZ, fragmentar, problemas
+
+
+@pytest.mark.parametrize("vector", CORPUS)
+def test_vectores_conocidos_quedan_inertes(vector):
+    assert problemas(sanitizar_markdown(vector)) == []
+
+
+@pytest.mark.parametrize("texto", INALTERADOS)
+def test_texto_legitimo_no_cambia(texto):
+    assert sanitizar_markdown(texto) == texto
+
+
+def test_stream_equivale_a_la_respuesta_completa():
+    rng = random.Random(20)
+    for _ in range(2000):
+        texto = "".join(rng.choice(PIEZAS_FUZZ) for _ in range(rng.randint(1, 40)))
+        completa = sanitizar_markdown(texto)
+        assert "".join(sanitizar_stream(fragmentar(texto, rng))) == completa, texto
+        assert problemas(completa) == [], texto
+
+
+def test_sanitizar_es_idempotente():
+    for vector in CORPUS:
+        una_vez = sanitizar_markdown(vector)
+        assert sanitizar_markdown(una_vez) == una_vez
+
+
+def test_imagen_sin_cerrar_no_frena_el_stream():
+    fragmentos = ["![alt", "(" + "x" * 5000] + ["y" * 10] * 3
+    emitido = list(sanitizar_stream(fragmentos))
+    assert len(emitido) > 1
+    assert "".join(emitido) == "&#33;[alt(" + "x" * 5000 + "y" * 30